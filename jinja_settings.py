@@ -0,0 +1,17 @@
+# ------------------------------
+# Réglages Jinja communs à l'application et à scripts/precompile_templates.py
+# ------------------------------
+# Module sans effet de bord : le script de build l'importe sans charger main
+import os
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Même dossier que celui de Flask (root_path/templates) : les clés du cache de bytecode en dépendent
+TEMPLATES_DIR = os.path.join(BASE_DIR, "templates")
+JINJA_CACHE_DIR = os.environ.get("JINJA_CACHE_DIR", os.path.join(BASE_DIR, ".jinja_cache"))
+
+def template_autoescape(name):
+    # Règle de Flask.select_jinja_autoescape : l'échappement est fixé à la compilation,
+    # le bytecode pré-compilé doit donc être produit avec la même règle
+    if name is None:
+        return True
+    return name.endswith((".html", ".htm", ".xml", ".xhtml", ".svg"))
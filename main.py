@@ -1,19 +1,38 @@
 #!/usr/bin/env python3
+import atexit
+import bisect
+import functools
+import multiprocessing
 import os
 import secrets
-import random
 import threading
 import webbrowser
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import time
-import io
 import socket
 import hashlib
+import hmac
 import json
 import logging
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
 from datetime import datetime, timedelta
-from flask import Flask, request, render_template_string, send_file, url_for, session, redirect, flash, make_response
-from fpdf import FPDF
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    from flask_compress import Compress
+except ImportError:
+    Compress = None
+from flask import Flask, Response, request, render_template, stream_with_context, url_for, session, redirect, flash, make_response
+from jinja2 import FileSystemBytecodeCache
+from jinja_settings import JINJA_CACHE_DIR
+from pdf_builder import build_exercises_pdf
 
 # ------------------------------
 # Configuration du logger
@@ -34,899 +53,400 @@ if "GOOGLE_CREDENTIALS_JSON" in os.environ:
 # Nom du bucket à utiliser (à définir via la variable d'environnement GCS_BUCKET_NAME)
 GCS_BUCKET_NAME = os.environ.get("GCS_BUCKET_NAME", "my-default-bucket")
 
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import storage
+from google.cloud.exceptions import NotFound
+from google.api_core.exceptions import NotModified
+
+# Connexions keep-alive conservées vers GCS : une par thread gunicorn (voir --threads du Procfile)
+GCS_HTTP_POOL_SIZE = 16
+
+# Client GCS partagé : construit une seule fois par processus (credentials + session HTTP réutilisés)
+_storage_client = None
+_storage_client_lock = threading.Lock()
+
+def get_storage_client():
+    global _storage_client
+    if _storage_client is None:
+        with _storage_client_lock:
+            if _storage_client is None:
+                credentials, project = google.auth.default(scopes=storage.Client.SCOPE)
+                http = AuthorizedSession(credentials)
+                http.mount("https://", HTTPAdapter(pool_connections=GCS_HTTP_POOL_SIZE, pool_maxsize=GCS_HTTP_POOL_SIZE))
+                _storage_client = storage.Client(project=project, credentials=credentials, _http=http)
+    return _storage_client
+
+# Handles de bucket mémorisés par nom (cache_clear() pour les invalider)
+@functools.lru_cache(maxsize=16)
+def get_bucket(bucket_name=GCS_BUCKET_NAME):
+    return get_storage_client().bucket(bucket_name)
+
+# Envoi en une seule requête pour les petits fichiers ; au-delà du seuil, envoi resumable
+# par blocs (la taille de bloc doit être un multiple de 256 Ko)
+GCS_RESUMABLE_THRESHOLD = 5 * 1024 * 1024
+GCS_UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
 
 def upload_bytes_to_gcs(file_bytes, filename, content_type='application/octet-stream', bucket_name=GCS_BUCKET_NAME):
-    client = storage.Client()
-    bucket = client.bucket(bucket_name)
+    bucket = get_bucket(bucket_name)
     blob = bucket.blob(filename)
+    if len(file_bytes) > GCS_RESUMABLE_THRESHOLD:
+        blob.chunk_size = GCS_UPLOAD_CHUNK_SIZE
     blob.upload_from_string(file_bytes, content_type=content_type)
     return blob.public_url
 
 # ------------------------------
 # Gestion des utilisateurs via GCS (stockage unique dans users.json)
 # ------------------------------
+# Référence vers users.json, créée une seule fois puis partagée par le chargement et l'autosave
+_users_blob = None
+
+def get_users_blob():
+    global _users_blob
+    if _users_blob is None:
+        _users_blob = get_bucket(GCS_BUCKET_NAME).blob("users.json")
+    return _users_blob
+
+# Génération GCS de users.json lue ou écrite en dernier (None si le fichier n'existe pas encore)
+_users_generation = None
+# Sérialise sauvegarde et relecture pour qu'une relecture n'écrase pas un envoi en cours
+_users_sync_lock = threading.Lock()
+
+def new_usage_count():
+    return {"easy": 0, "intermediate": 0, "hard": 0, "very hard": 0, "expert": 0, "total": 0}
+
+def parse_users(content):
+    data = orjson.loads(content) if orjson is not None else json.loads(content)
+    for email, info in data.items():
+        if "plan_start" in info and info["plan_start"]:
+            info["plan_start"] = datetime.fromisoformat(info["plan_start"])
+        # Compteurs complétés une fois au chargement : le reste du code les indexe directement
+        info["usage_count"] = {**new_usage_count(), **info.get("usage_count", {})}
+    return data
+
 def load_users():
+    global _users_generation
     try:
-        client = storage.Client()
-        bucket = client.bucket(GCS_BUCKET_NAME)
-        blob = bucket.blob("users.json")
-        if blob.exists():
-            content = blob.download_as_string().decode("utf-8")
-            data = json.loads(content)
-            for email, info in data.items():
-                if "plan_start" in info and info["plan_start"]:
-                    info["plan_start"] = datetime.fromisoformat(info["plan_start"])
-            return data
-        else:
+        blob = get_users_blob()
+        # Un seul aller-retour : l'absence du fichier est signalée par NotFound
+        try:
+            content = blob.download_as_bytes()
+        except NotFound:
             return {}
+        _users_generation = blob.generation
+        return parse_users(content)
     except Exception as e:
         logger.error("Error loading users: %s", e)
         return {}
 
-def save_users():
-    try:
-        data_to_save = {}
-        for email, info in users.items():
-            data = info.copy()
-            if "plan_start" in data and isinstance(data["plan_start"], datetime):
-                data["plan_start"] = data["plan_start"].isoformat()
-            data_to_save[email] = data
-        content = json.dumps(data_to_save, indent=4)
-        client = storage.Client()
-        bucket = client.bucket(GCS_BUCKET_NAME)
-        blob = bucket.blob("users.json")
-        blob.upload_from_string(content, content_type="application/json")
-    except Exception as e:
-        logger.error("Error saving users: %s", e)
-
-# Chargement initial des utilisateurs
-users = load_users()
+def refresh_users():
+    global _users_generation
+    with _users_sync_lock:
+        # Les modifications locales en attente priment sur la copie distante
+        if users_dirty.is_set():
+            return
+        try:
+            blob = get_users_blob()
+            # Téléchargement conditionnel : GCS répond 304 si la génération n'a pas changé
+            content = blob.download_as_bytes(if_generation_not_match=_users_generation)
+            generation = blob.generation
+            data = parse_users(content)
+        except (NotModified, NotFound):
+            return
+        except Exception as e:
+            logger.error("Error refreshing users: %s", e)
+            return
+        # Remplacement sans fenêtre vide : les threads de requête lisent users sans verrou, et les
+        # fiches déjà en main (user_data = users[email]) restent les objets mis à jour
+        for email, info in data.items():
+            current = users.get(email)
+            if current is None:
+                users[email] = info
+            else:
+                replace_dict_contents(current, info)
+        for email in users.keys() - data.keys():
+            del users[email]
+        rebuild_remember_tokens()
+        _users_generation = generation
 
-# Variable globale pour marquer les données modifiées
-users_dirty = False
+def save_users():
+    global _users_generation
+    with _users_sync_lock:
+        try:
+            if orjson is not None:
+                # orjson sérialise directement les datetime (plan_start) au format ISO, sans copie préalable ;
+                # JSON compact (sans indentation) : fichier plus petit à encoder et à envoyer
+                content = orjson.dumps(users)
+            else:
+                data_to_save = {}
+                for email, info in users.items():
+                    data = info.copy()
+                    if "plan_start" in data and isinstance(data["plan_start"], datetime):
+                        data["plan_start"] = data["plan_start"].isoformat()
+                    data_to_save[email] = data
+                content = json.dumps(data_to_save, separators=(",", ":"))
+            blob = get_users_blob()
+            blob.upload_from_string(content, content_type="application/json")
+            _users_generation = blob.generation
+        except Exception as e:
+            logger.error("Error saving users: %s", e)
+
+# Utilisateurs en mémoire, chargés à la première requête de chaque worker (voir ensure_users_loaded)
+users = {}
+
+# Index inverse jeton "remember me" -> email, reconstruit à chaque (re)chargement de users
+_token_to_email = {}
+
+def replace_dict_contents(target, data):
+    # Mise à jour en place, sans vider le dict au préalable
+    target.update(data)
+    for key in target.keys() - data.keys():
+        del target[key]
+
+def rebuild_remember_tokens():
+    tokens = {data["remember_token"]: email for email, data in list(users.items()) if data.get("remember_token")}
+    replace_dict_contents(_token_to_email, tokens)
+
+def set_remember_token(email, token):
+    old_token = users[email].get("remember_token")
+    if old_token:
+        _token_to_email.pop(old_token, None)
+    users[email]["remember_token"] = token
+    _token_to_email[token] = email
+
+def clear_remember_token(email):
+    old_token = users[email].pop("remember_token", None)
+    if old_token:
+        _token_to_email.pop(old_token, None)
+    # Indique si users a réellement changé (sinon inutile de sauvegarder)
+    return old_token is not None
+
+# Délai (en secondes) regroupant les modifications avant sauvegarde
+USERS_AUTOSAVE_DELAY = 5
+
+# Événement marquant les données modifiées (réveille le thread d'autosave)
+users_dirty = threading.Event()
 
 def mark_users_dirty():
-    global users_dirty
-    users_dirty = True
+    users_dirty.set()
 
 def autosave_users():
-    global users_dirty
     while True:
-        if users_dirty:
-            save_users()
-            users_dirty = False
-        time.sleep(5)
-
-# Démarrage du thread d'autosave (daemon afin qu'il ne bloque pas l'arrêt de l'application)
-autosave_thread = threading.Thread(target=autosave_users, daemon=True)
-autosave_thread.start()
+        users_dirty.wait()
+        # Regroupe les modifications rapprochées en un seul envoi vers GCS
+        time.sleep(USERS_AUTOSAVE_DELAY)
+        users_dirty.clear()
+        save_users()
+
+def flush_users():
+    if users_dirty.is_set():
+        users_dirty.clear()
+        save_users()
+
+# Sauvegarde des modifications en attente à l'arrêt du processus
+atexit.register(flush_users)
+
+_users_loaded = False
+_users_load_lock = threading.Lock()
+
+# Intervalle (en secondes) entre deux vérifications de users.json sur GCS
+USERS_REFRESH_INTERVAL = 60
+_users_checked_at = 0.0
+
+def ensure_users_loaded():
+    global _users_loaded, _users_checked_at
+    if not _users_loaded:
+        with _users_load_lock:
+            if not _users_loaded:
+                users.update(load_users())
+                rebuild_remember_tokens()
+                _users_checked_at = time.monotonic()
+                # Démarrage du thread d'autosave (daemon afin qu'il ne bloque pas l'arrêt de l'application)
+                threading.Thread(target=autosave_users, daemon=True).start()
+                _users_loaded = True
+
+def refresh_users_if_stale():
+    global _users_checked_at
+    now = time.monotonic()
+    if now - _users_checked_at < USERS_REFRESH_INTERVAL:
+        return
+    _users_checked_at = now
+    refresh_users()
 
 # ------------------------------
 # Fonctions utilitaires et de génération d'exercices
 # ------------------------------
+# Préfixe des empreintes BLAKE2b ; les anciennes empreintes SHA-256 n'en ont pas
+PASSWORD_HASH_PREFIX = "b2$"
+
 def hash_password(password):
-    return hashlib.sha256(password.encode('utf-8')).hexdigest()
+    return PASSWORD_HASH_PREFIX + hashlib.blake2b(password.encode('utf-8'), digest_size=32).hexdigest()
+
+def check_password(password, stored_hash):
+    # Empreintes hexadécimales (ASCII) comparées en temps constant
+    if stored_hash.startswith(PASSWORD_HASH_PREFIX):
+        return hmac.compare_digest(stored_hash, hash_password(password))
+    return hmac.compare_digest(stored_hash, hashlib.sha256(password.encode('utf-8')).hexdigest())
+
+def secret_answer_matches(expected, given):
+    # Réponses de vérification (noms des parents) comparées en temps constant, en octets UTF-8
+    return hmac.compare_digest((expected or "").encode('utf-8'), (given or "").encode('utf-8'))
+
+# Nombres d'opérations proposés par le formulaire de sélection (selection.html)
+NB_OPS_CHOICES = (10, 20, 50, 100, 200, 400, 600)
+
+# Bornes (incluses) des opérandes par niveau
+ADD_SUB_RANGES = {'easy': (0, 10), 'intermediate': (0, 50), 'hard': (0, 100), 'very hard': (0, 200), 'expert': (0, 1000000)}
+MUL_RANGES = {'easy': (0, 5), 'intermediate': (0, 10), 'hard': (0, 20), 'very hard': (0, 30), 'expert': (0, 1000)}
+# Division : (bornes du diviseur, bornes du quotient)
+DIV_RANGES = {'easy': ((1, 5), (0, 5)), 'intermediate': ((1, 10), (0, 10)), 'hard': ((1, 20), (0, 20)),
+              'very hard': ((1, 30), (0, 30)), 'expert': ((1, 100), (0, 10000))}
 
-def generate_exercise(operation, level):
+_rng = np.random.default_rng()
+
+# Seuils 10, 100, ... : le nombre de chiffres d'un résultat positif est sa position dans ce tableau + 1
+DIGIT_THRESHOLDS = 10 ** np.arange(1, 19, dtype=np.int64)
+
+def generate_exercises(operation, level, n, rng=_rng):
+    # Tous les opérandes d'une série sont tirés en un seul appel NumPy
     if operation in ['addition', 'subtraction']:
-        if level == 'easy':
-            low, high = 0, 10
-        elif level == 'intermediate':
-            low, high = 0, 50
-        elif level == 'hard':
-            low, high = 0, 100
-        elif level == 'very hard':
-            low, high = 0, 200
-        elif level == 'expert':
-            low, high = 0, 1000000
-        a = random.randint(low, high)
+        low, high = ADD_SUB_RANGES[level]
+        a = rng.integers(low, high, size=n, endpoint=True)
         if operation == 'addition':
-            b = random.randint(low, high)
-            result = a + b
-            return {'a': a, 'b': b, 'op': '+', 'result': result, 'res_len': len(str(result))}
+            b = rng.integers(low, high, size=n, endpoint=True)
+            op, result = '+', a + b
         else:
-            b = random.randint(low, a)
-            result = a - b
-            return {'a': a, 'b': b, 'op': '-', 'result': result, 'res_len': len(str(result))}
+            b = rng.integers(low, a, endpoint=True)
+            op, result = '-', a - b
     elif operation == 'multiplication':
-        if level == 'easy':
-            low, high = 0, 5
-        elif level == 'intermediate':
-            low, high = 0, 10
-        elif level == 'hard':
-            low, high = 0, 20
-        elif level == 'very hard':
-            low, high = 0, 30
-        elif level == 'expert':
-            low, high = 0, 1000
-        a = random.randint(low, high)
-        b = random.randint(low, high)
-        result = a * b
-        return {'a': a, 'b': b, 'op': '×', 'result': result, 'res_len': len(str(result))}
+        low, high = MUL_RANGES[level]
+        a = rng.integers(low, high, size=n, endpoint=True)
+        b = rng.integers(low, high, size=n, endpoint=True)
+        op, result = '×', a * b
     elif operation == 'division':
-        if level == 'easy':
-            b_low, b_high = 1, 5; q_low, q_high = 0, 5
-        elif level == 'intermediate':
-            b_low, b_high = 1, 10; q_low, q_high = 0, 10
-        elif level == 'hard':
-            b_low, b_high = 1, 20; q_low, q_high = 0, 20
-        elif level == 'very hard':
-            b_low, b_high = 1, 30; q_low, q_high = 0, 30
-        elif level == 'expert':
-            b_low, b_high = 1, 100; q_low, q_high = 0, 10000
-        b = random.randint(b_low, b_high)
-        quotient = random.randint(q_low, q_high)
-        a = b * quotient
-        return {'a': a, 'b': b, 'op': '÷', 'result': quotient, 'res_len': len(str(quotient))}
-
-def draw_exercise_box(pdf, ex_num, ex, x, y, col_width, line_height, solution_text=None):
-    num_width = 12
-    content_width = col_width - num_width
-    pdf.set_font("Courier", "", 8)
-    pdf.set_xy(x, y)
-    pdf.cell(num_width, line_height, f"{ex_num}.", border=0, align="R")
-    pdf.set_font("Courier", "", 12)
-    pdf.set_xy(x + num_width, y)
-    pdf.cell(content_width, line_height, f"{ex['a']}", border=0, align="R", ln=1)
-    pdf.set_xy(x, y + line_height)
-    op_sym = ex["op"]
-    if op_sym in ["*", "×"]:
-        op_sym = "×"
-    elif op_sym in ["/", "÷"]:
-        op_sym = "÷"
-    pdf.cell(num_width, line_height, op_sym, border=0, align="R")
-    pdf.set_xy(x + num_width, y + line_height)
-    pdf.cell(content_width, line_height, f"{ex['b']}", border='B', align="R", ln=1)
-    pdf.set_xy(x, y + 2 * line_height)
-    pdf.cell(num_width, line_height, "=", border=0, align="R")
-    pdf.set_xy(x + num_width, y + 2 * line_height)
-    if solution_text is None:
-        pdf.cell(content_width, line_height, "", border='B', align="R", ln=1)
+        (b_low, b_high), (q_low, q_high) = DIV_RANGES[level]
+        b = rng.integers(b_low, b_high, size=n, endpoint=True)
+        result = rng.integers(q_low, q_high, size=n, endpoint=True)
+        op, a = '÷', b * result
     else:
-        pdf.cell(content_width, line_height, f"{solution_text}", border=0, align="R", ln=1)
+        return [None] * n
+    res_len = np.searchsorted(DIGIT_THRESHOLDS, result, side='right') + 1
+    # Largeur (px) du champ de réponse : 10 px par chiffre, 40 px au minimum
+    input_width = np.maximum(40, 10 * res_len)
+    return [{'a': x, 'b': y, 'op': op, 'result': r, 'res_len': l, 'input_width': w}
+            for x, y, r, l, w in zip(a.tolist(), b.tolist(), result.tolist(), res_len.tolist(), input_width.tolist())]
 
 # ------------------------------
-# Templates HTML (navigation, footer, pages)
+# Préchargement des séries d'exercices
 # ------------------------------
-nav_html = """
-<nav class="navbar navbar-expand-lg navbar-light mac-navbar">
-  <div class="container-fluid">
-    <button class="navbar-toggler" type="button" data-bs-toggle="collapse" data-bs-target="#navbarNav" 
-            aria-controls="navbarNav" aria-expanded="false" aria-label="Toggle navigation">
-      <span class="navbar-toggler-icon"></span>
-    </button>
-    <a class="navbar-brand" href="/"><i class="fas fa-graduation-cap"></i> MathSTK-Ex</a>
-    <div class="collapse navbar-collapse" id="navbarNav">
-      <ul class="navbar-nav ms-auto">
-        {% if session.user %}
-          <li class="nav-item"><a class="nav-link" href="/"><i class="fas fa-home"></i> Home</a></li>
-          <li class="nav-item"><a class="nav-link" href="/activation"><i class="fas fa-unlock"></i> Activation</a></li>
-          <li class="nav-item"><a class="nav-link" href="/change_password"><i class="fas fa-key"></i> Change Password</a></li>
-          <li class="nav-item"><a class="nav-link" href="/logout"><i class="fas fa-sign-out-alt"></i> Logout</a></li>
-        {% else %}
-          <li class="nav-item"><a class="nav-link" href="/login"><i class="fas fa-sign-in-alt"></i> Login</a></li>
-          <li class="nav-item"><a class="nav-link" href="/register"><i class="fas fa-user-plus"></i> Register</a></li>
-          <li class="nav-item"><a class="nav-link" href="/forgot_password"><i class="fas fa-unlock-alt"></i> Forgot Password</a></li>
-        {% endif %}
-        <li class="nav-item">
-          <div class="theme-select">
-            <select id="themeSelect" onchange="changeTheme(this.value)" class="form-select">
-              <option value="blue" {% if session.theme == 'blue' %}selected{% endif %}>Blue</option>
-              <option value="pink" {% if session.theme == 'pink' %}selected{% endif %}>Pink</option>
-              <option value="green" {% if session.theme == 'green' %}selected{% endif %}>Green</option>
-              <option value="yellow" {% if session.theme == 'yellow' %}selected{% endif %}>Yellow</option>
-              <option value="kid_friendly" {% if session.theme == 'kid_friendly' %}selected{% endif %}>Kid Friendly</option>
-            </select>
-          </div>
-        </li>
-      </ul>
-    </div>
-  </div>
-</nav>
-<div class="nav-arrows">
-  <div class="arrow-left">
-    <a href="javascript:history.back()"><i class="fas fa-arrow-circle-left"></i></a>
-  </div>
-  <div class="arrow-right">
-    <a href="javascript:history.forward()"><i class="fas fa-arrow-circle-right"></i></a>
-  </div>
-</div>
-<style>
-  .theme-select { margin-left: 20px; display: flex; align-items: center; }
-  .theme-select select { -webkit-appearance: none; -moz-appearance: none; appearance: none; }
-  .nav-arrows { display: flex; justify-content: space-between; padding: 10px 20px; }
-  .nav-arrows .arrow-left, .nav-arrows .arrow-right { font-size: 2em; color: #333; }
-  .nav-arrows a { text-decoration: none; color: inherit; }
-</style>
-<script>
-function changeTheme(theme) {
-    window.location.href = "/set_theme/" + theme;
-}
-</script>
-"""
-
-footer_html = """
-<div class="card-footer text-center footer mac-footer">
-  SASTOUKA DIGITAL © 2025 sastoukadigital@gmail.com • Whatsapp +212652084735<br>
-  Access via local network: <span>{{ host_address }}</span>
-</div>
-<style>
-  .mac-footer { background: rgba(255, 255, 255, 0.85); backdrop-filter: blur(10px); color: #343a40; margin-top:20px; font-size: 0.9em; }
-</style>
-<script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js"></script>
-"""
-
-common_theme_css = """
-<style>
-  body.blue { background-color: #D0E7FF; color: #333; }
-  body.pink { background-color: #FFD1DC; color: #333; }
-  body.green { background-color: #D0FFD6; color: #333; }
-  body.yellow { background-color: #FFFAD1; color: #333; }
-  body.kid_friendly { background: linear-gradient(135deg, #FFEEAD, #FF6F69); color: #333; }
-  h1, h2, h3, .navbar-brand { font-family: 'Fredoka One', cursive; }
-  p, label, input, select, button { font-family: 'Poppins', sans-serif; }
-  @keyframes popIn { 0% { transform: scale(0.8); opacity: 0; } 100% { transform: scale(1); opacity: 1; } }
-  .btn { animation: popIn 0.5s ease-out; transition: transform 0.2s; }
-  .btn:hover { transform: scale(1.1); }
-  @keyframes bounceIn { 0% { transform: scale(0.5); opacity: 0; } 60% { transform: scale(1.2); opacity: 1; } 100% { transform: scale(1); } }
-  h1 { animation: bounceIn 0.7s ease-out; }
-  .score-motivation { animation: pulse 1s infinite; }
-  @keyframes pulse { 0% { transform: scale(1); } 50% { transform: scale(1.05); } 100% { transform: scale(1); } }
-</style>
-<link href="https://fonts.googleapis.com/css2?family=Fredoka+One&family=Poppins:wght@400;600&display=swap" rel="stylesheet">
-"""
-
-meta_head = """
-<meta charset="utf-8">
-<meta name="viewport" content="width=device-width, initial-scale=1, maximum-scale=1, user-scalable=no">
-<link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0-beta3/css/all.min.css">
-<link rel="manifest" href="/static/manifest.json">
-"""
-
-# Templates pour les pages (sélection, exercices, résultats, plan, login, register, etc.)
-selection_template = """
-<!doctype html>
-<html lang="en">
-  <head>
-    """ + meta_head + """
-    <title>Math Exercises Selection</title>
-    <link rel="manifest" href="/static/manifest.json">
-    <link rel="stylesheet" href="https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css">
-    <link href="https://fonts.googleapis.com/css2?family=Poppins:wght@400;600&display=swap" rel="stylesheet">
-    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/animate.css/4.1.1/animate.min.css">
-    <script src="https://code.jquery.com/jquery-3.5.1.slim.min.js"></script>
-    <script src="https://cdn.jsdelivr.net/npm/bootstrap@4.5.2/dist/js/bootstrap.bundle.min.js"></script>
-    """ + common_theme_css + """
-    <style>
-      body { padding-left: 20px; padding-right: 20px; }
-      .content-container { margin-top: 20px; }
-      .form-container { max-width: 500px; margin: auto; background: rgba(255, 255, 255, 0.95); padding: 20px; border-radius: 15px; box-shadow: 0 8px 20px rgba(0,0,0,0.1); backdrop-filter: blur(5px); }
-      #installButton { display: none; margin-bottom: 20px; transition: transform 0.3s ease; }
-      #installButton:hover { transform: scale(1.05); }
-      .btn { transition: all 0.3s ease; border-radius: 25px; padding: 10px 20px; font-weight: bold; }
-      .btn-primary { background: linear-gradient(135deg, #FF9900, #FFCC00); border: none; }
-      .btn-primary:hover { transform: translateY(-2px); box-shadow: 0 4px 15px rgba(0,0,0,0.2); }
-      .plan-info { background: rgba(255, 255, 255, 0.95); border-radius: 8px; padding: 15px; margin-bottom: 15px; backdrop-filter: blur(5px); }
-      @media (max-width: 576px) { .form-container { padding: 15px; } h1 { font-size: 1.8em; } }
-    </style>
-  </head>
-  <body class="{{ session.theme }}">
-    """ + nav_html + """
-    <div class="container content-container animate__animated animate__fadeIn">
-      <button id="installButton" class="btn btn-info btn-block"><i class="fas fa-download"></i> Install</button>
-      <h1 class="mb-4 text-center">Math Exercises</h1>
-      {% if user_plan == 'free' %}
-      <div class="plan-info">
-        <p>Free Plan: 1 use per level.</p>
-        <ul>
-          <li>Easy : {{ usage_count['easy'] }}/1</li>
-          <li>Intermediate : {{ usage_count['intermediate'] }}/1</li>
-          <li>Hard : {{ usage_count['hard'] }}/1</li>
-          <li>Very Hard : {{ usage_count['very hard'] }}/1</li>
-          <li>Expert : {{ usage_count['expert'] }}/1</li>
-        </ul>
-      </div>
-      {% elif user_plan == 'monthly' %}
-      <div class="plan-info">
-        <p>Monthly Plan: Unlimited access for 30 days.</p>
-        <p>Start Date: {{ plan_start }} (expires on {{ plan_end }})</p>
-      </div>
-      {% elif user_plan == 'twenty' %}
-      <div class="plan-info">
-        <p>20-Tries Plan: Maximum 20 uses, all levels.</p>
-        <p>Uses: {{ usage_count['total'] }}/20</p>
-      </div>
-      {% endif %}
-      <form method="POST">
-        <input type="hidden" name="phase" value="generate">
-        <div class="form-group">
-          <label for="level">Select Level:</label>
-          <select class="form-control" id="level" name="level" required>
-            <option value="easy" {% if not can_use['easy'] %}disabled{% endif %}>Easy</option>
-            <option value="intermediate" {% if not can_use['intermediate'] %}disabled{% endif %}>Intermediate</option>
-            <option value="hard" {% if not can_use['hard'] %}disabled{% endif %}>Hard</option>
-            <option value="very hard" {% if not can_use['very hard'] %}disabled{% endif %}>Very Hard</option>
-            <option value="expert" {% if not can_use['expert'] %}disabled{% endif %}>Expert</option>
-          </select>
-        </div>
-        <div class="form-group">
-          <label for="category">Select Category:</label>
-          <select class="form-control" id="category" name="category" required>
-            <option value="addition">Addition</option>
-            <option value="subtraction">Subtraction</option>
-            <option value="multiplication">Multiplication</option>
-            <option value="division">Division</option>
-            <option value="all">All Operations</option>
-          </select>
-        </div>
-        <div class="form-group">
-          <label for="nb_ops">Number of Operations:</label>
-          <select class="form-control" id="nb_ops" name="nb_ops" required>
-            <option value="10">10</option>
-            <option value="20">20</option>
-            <option value="50">50</option>
-            <option value="100" selected>100</option>
-            <option value="200">200</option>
-            <option value="400">400</option>
-            <option value="600">600</option>
-          </select>
-        </div>
-        <div class="form-group">
-          <label for="pdf_columns">Number of PDF Columns:</label>
-          <select class="form-control" id="pdf_columns" name="pdf_columns" required>
-            <option value="3" selected>3</option>
-            <option value="4">4</option>
-            <option value="5">5</option>
-            <option value="6">6</option>
-          </select>
-        </div>
-        <button id="generateBtn" type="submit" class="btn btn-primary btn-block"><i class="fas fa-play"></i> Generate Exercises</button>
-      </form>
-      """ + footer_html + """
-    </div>
-    <script>
-      if ('serviceWorker' in navigator) {
-        navigator.serviceWorker.register('/static/sw.js')
-          .then(function(registration) {
-            console.log('Service Worker registered:', registration.scope);
-          })
-          .catch(function(error) {
-            console.log('Service Worker error:', error);
-          });
-      }
-      let deferredPrompt;
-      const installButton = document.getElementById('installButton');
-      window.addEventListener('beforeinstallprompt', (e) => {
-        e.preventDefault();
-        deferredPrompt = e;
-        installButton.style.display = 'block';
-      });
-      installButton.addEventListener('click', async () => {
-        if (deferredPrompt) {
-          deferredPrompt.prompt();
-          const { outcome } = await deferredPrompt.userChoice;
-          console.log('User response:', outcome);
-          deferredPrompt = null;
-          installButton.style.display = 'none';
-        } else {
-          alert("Installation not available.");
-        }
-      });
-    </script>
-  </body>
-</html>
-"""
-
-exercise_template = """
-<!doctype html>
-<html lang="en">
-  <head>
-    """ + meta_head + """
-    <title>Exercises - Level {{ level|capitalize }} - {% if selected_category=='all' %}All{% else %}{{ selected_category|capitalize }}{% endif %}</title>
-    <link rel="stylesheet" href="https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css">
-    <link href="https://fonts.googleapis.com/css2?family=Poppins:wght@400;600&display=swap" rel="stylesheet">
-    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/animate.css/4.1.1/animate.min.css">
-    """ + common_theme_css + """
-    <style>
-      body { padding-left: 20px; padding-right: 20px; }
-      h1 { text-align: center; margin-bottom: 30px; animation: fadeInDown 0.8s ease; }
-      .exercise { display: inline-block; margin: 10px; padding: 10px; background: rgba(255, 255, 255, 0.95); border-radius: 8px; box-shadow: 0 4px 10px rgba(0,0,0,0.1); width: 150px; transition: transform 0.3s ease, box-shadow 0.3s ease; }
-      .exercise:hover { transform: translateY(-5px); box-shadow: 0 6px 20px rgba(0,0,0,0.15); }
-      table { width: 100%; }
-      td { vertical-align: top; }
-      .right { text-align: right; }
-      .underline { border-bottom: 2px solid #000; min-width: 40px; display: inline-block; }
-      .input-answer { border: none; border-bottom: 1px solid #ccc; text-align: right; background: transparent; transition: border-color 0.3s ease; }
-      .input-answer:focus { outline: none; border-color: #FF9900; }
-      @keyframes fadeInDown { from { opacity: 0; transform: translateY(-20px); } to { opacity: 1; transform: translateY(0); } }
-      @media (max-width: 576px) { .exercise { width: 100px; padding: 5px; } .input-answer { width: 40px !important; } }
-    </style>
-  </head>
-  <body class="{{ session.theme }}">
-    """ + nav_html + """
-    <div class="container animate__animated animate__fadeIn">
-      <h1>Exercises - Level {{ level|capitalize }} - {% if selected_category=='all' %}All{% else %}{{ selected_category|capitalize }}{% endif %}</h1>
-      <form method="POST" action="/answers">
-        <input type="hidden" name="phase" value="answers">
-        <input type="hidden" name="level" value="{{ level }}">
-        <input type="hidden" name="selected_category" value="{{ selected_category }}">
-        <input type="hidden" name="theme" value="{{ session.theme }}">
-        {% for cat, ex_list in exercises.items() %}
-          <div class="category">
-            <h2 class="category-title">{{ cat|capitalize }}</h2>
-            <div class="row">
-              {% for ex in ex_list %}
-              <div class="col-md-3 col-sm-4 col-6">
-                <div class="exercise">
-                  <div class="number">{{ loop.index }}.</div>
-                  <table>
-                    <tr>
-                      <td class="right" colspan="2">{{ ex.a }}</td>
-                    </tr>
-                    <tr>
-                      <td class="right" style="width:30px;">{{ ex.op }}</td>
-                      <td class="right"><span class="underline">{{ ex.b }}</span></td>
-                    </tr>
-                    <tr>
-                      <td class="right">=</td>
-                      <td class="right">
-                        <input type="text" name="{{ cat }}_{{ loop.index0 }}" class="input-answer" style="width:{{ 10 * ex.res_len if 10 * ex.res_len > 40 else 40 }}px;">
-                      </td>
-                    </tr>
-                  </table>
-                </div>
-              </div>
-              <input type="hidden" name="{{ cat }}_{{ loop.index0 }}_a" value="{{ ex.a }}">
-              <input type="hidden" name="{{ cat }}_{{ loop.index0 }}_b" value="{{ ex.b }}">
-              <input type="hidden" name="{{ cat }}_{{ loop.index0 }}_op" value="{{ ex.op }}">
-              {% endfor %}
-            </div>
-          </div>
-        {% endfor %}
-        <div class="row">
-          <div class="col-md-6">
-            <button type="submit" class="btn btn-success btn-block mt-4"><i class="fas fa-check"></i> Submit</button>
-          </div>
-          <div class="col-md-6">
-            <a href="/generate_pdf" class="btn btn-info btn-block mt-4"><i class="fas fa-file-pdf"></i> PDF</a>
-          </div>
-        </div>
-      </form>
-      """ + footer_html + """
-    </div>
-  </body>
-</html>
-"""
-
-result_template = """
-<!doctype html>
-<html lang="en">
-  <head>
-    """ + meta_head + """
-    <title>Results</title>
-    <link rel="stylesheet" href="https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css">
-    <link href="https://fonts.googleapis.com/css2?family=Poppins:wght@400;600&display=swap" rel="stylesheet">
-    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/animate.css/4.1.1/animate.min.css">
-    """ + common_theme_css + """
-    <style>
-      body { padding-left: 20px; padding-right: 20px; }
-      h1 { text-align: center; margin-bottom: 30px; animation: fadeInDown 0.8s ease; }
-      .result { font-family: monospace; padding: 10px; margin: 5px 0; border-radius: 5px; transition: all 0.3s ease; }
-      .correct { background-color: rgba(0, 255, 0, 0.2); }
-      .incorrect { background-color: rgba(255, 0, 0, 0.2); }
-      .category { margin-bottom: 30px; }
-      .btn-container { margin-top: 20px; }
-      .score-motivation { text-align: center; font-size: 1.5em; margin: 20px 0; padding: 10px; border-radius: 10px; background: linear-gradient(135deg, #FF9900, #FFCC00); color: white; box-shadow: 0 4px 15px rgba(0,0,0,0.2); }
-      @keyframes fadeInDown { from { opacity: 0; transform: translateY(-20px); } to { opacity: 1; transform: translateY(0); } }
-      @media (max-width: 576px) { h1 { font-size: 1.8em; } }
-    </style>
-  </head>
-  <body class="{{ theme }}">
-    """ + nav_html + """
-    <div class="container animate__animated animate__fadeIn">
-      <h1>Results</h1>
-      <div class="score-motivation animate__animated animate__bounceIn">
-        {% if score >= 0 and score <= 20 %}
-          Don't worry, keep practicing!
-        {% elif score >= 21 and score <= 40 %}
-          You're making progress, keep it up!
-        {% elif score >= 41 and score <= 60 %}
-          Well done, you're on the right track!
-        {% elif score >= 61 and score <= 80 %}
-          Excellent work, you're almost at the top!
-        {% elif score >= 81 and score <= 100 %}
-          Congratulations, you're a champion!
-        {% endif %}
-      </div>
-      {% for cat, results in feedback.items() %}
-        <div class="category">
-          <h2>{{ cat|capitalize }}</h2>
-          {% for res in results %}
-            <div class="result {% if res.correct %}correct{% else %}incorrect{% endif %} animate__animated animate__fadeIn">
-              {{ res.text }}
-            </div>
-          {% endfor %}
-        </div>
-      {% endfor %}
-      <div class="btn-container row">
-        <div class="col-md-6">
-          <a href="/generate_pdf" class="btn btn-info btn-block"><i class="fas fa-file-pdf"></i> Download PDF</a>
-        </div>
-        <div class="col-md-6">
-          <a href="/" class="btn btn-secondary btn-block"><i class="fas fa-redo"></i> Restart</a>
-        </div>
-      </div>
-      """ + footer_html + """
-    </div>
-  </body>
-</html>
-"""
-
-choose_plan_template = """
-<!doctype html>
-<html>
-  <head>
-    """ + meta_head + """
-    <title>Choose a Plan</title>
-    <link rel="stylesheet" href="https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css">
-    <script src="https://code.jquery.com/jquery-3.5.1.slim.min.js"></script>
-    <script src="https://cdn.jsdelivr.net/npm/bootstrap@4.5.2/dist/js/bootstrap.bundle.min.js"></script>
-    """ + common_theme_css + """
-    <style>
-      body { padding-left: 20px; padding-right: 20px; }
-      .container { max-width: 600px; margin-top: 50px; background: rgba(255,255,255,0.95); padding: 30px; border-radius: 15px; box-shadow: 0 8px 20px rgba(0,0,0,0.1); }
-      .plan-footer { margin-top: 30px; text-align: center; font-size: 0.9em; color: #343a40; }
-      @media (max-width: 576px) { .container { padding: 20px; } }
-    </style>
-  </head>
-  <body class="{{ session.theme }}">
-    """ + nav_html + """
-    <div class="container mt-5">
-      <h1>Choose Your Plan</h1>
-      <p>Please select one of the options:</p>
-      <form method="POST">
-        <div class="form-check">
-          <input class="form-check-input" type="radio" name="plan" id="planFree" value="free"
-            {% if free_disabled %}disabled{% endif %} required>
-          <label class="form-check-label" for="planFree">
-            Free (1 use per level){% if free_disabled %} - Already used up{% endif %}
-          </label>
-        </div>
-        <div class="form-check">
-          <input class="form-check-input" type="radio" name="plan" id="planMonthly" value="monthly" required>
-          <label class="form-check-label" for="planMonthly">
-            1 Month $10 (Unlimited access for 30 days) - Payment via PayPal
-          </label>
-        </div>
-        <div class="form-check">
-          <input class="form-check-input" type="radio" name="plan" id="planTwenty" value="twenty" required>
-          <label class="form-check-label" for="planTwenty">
-            20 Tries $5 (Maximum 20 uses) - Payment via PayPal
-          </label>
-        </div>
-        <button type="submit" class="btn btn-primary mt-3"><i class="fas fa-check"></i> Submit</button>
-      </form>
-      <div class="plan-footer">
-        SASTOUKA DIGITAL © 2025 sastoukadigital@gmail.com • Whatsapp +212652084735
-      </div>
-    </div>
-  </body>
-</html>
-"""
-
-login_template = """
-<!doctype html>
-<html lang="en">
-  <head>
-    """ + meta_head + """
-    <title>Login</title>
-    <link rel="stylesheet" href="https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css">
-    <link href="https://fonts.googleapis.com/css2?family=Poppins:wght@400;600&display=swap" rel="stylesheet">
-    """ + common_theme_css + """
-    <style>
-      body { padding-left: 20px; padding-right: 20px; }
-      .login-container {
-        max-width: 400px;
-        margin: 50px auto;
-        background: rgba(255,255,255,0.95);
-        padding: 30px;
-        border-radius: 15px;
-        box-shadow: 0 8px 20px rgba(0,0,0,0.1);
-      }
-      .btn-secondary {
-        margin-top: 10px;
-      }
-    </style>
-  </head>
-  <body class="{{ session.theme }}">
-    """ + nav_html + """
-    <div class="container login-container">
-      <h1 class="text-center mb-4"><i class="fas fa-sign-in-alt"></i> Login</h1>
-      <form method="POST" action="/login">
-        <div class="form-group">
-          <label for="email"><i class="fas fa-envelope"></i> Email</label>
-          <input type="email" id="email" name="email" required class="form-control" placeholder="Enter your email">
-        </div>
-        <div class="form-group">
-          <label for="password"><i class="fas fa-lock"></i> Password</label>
-          <input type="password" id="password" name="password" required class="form-control" placeholder="Enter your password">
-        </div>
-        <div class="form-check mb-3">
-          <input class="form-check-input" type="checkbox" name="remember" id="rememberMe">
-          <label class="form-check-label" for="rememberMe">Remember me</label>
-        </div>
-        <button type="submit" class="btn btn-primary btn-block"><i class="fas fa-sign-in-alt"></i> Login</button>
-      </form>
-      <div class="text-center mt-3">
-        <a href="/register" class="btn btn-secondary btn-block"><i class="fas fa-user-plus"></i> S'enregistrer</a>
-        <a href="/forgot_password" class="btn btn-secondary btn-block"><i class="fas fa-unlock-alt"></i> Mot de passe oublié</a>
-      </div>
-    </div>
-    <script src="https://code.jquery.com/jquery-3.5.1.slim.min.js"></script>
-    <script src="https://cdn.jsdelivr.net/npm/bootstrap@4.5.2/dist/js/bootstrap.bundle.min.js"></script>
-  </body>
-</html>
-"""
-
-register_template = """
-<!doctype html>
-<html>
-  <head>
-    """ + meta_head + """
-    <title>Register</title>
-    <link rel="stylesheet" href="https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css">
-    <script src="https://code.jquery.com/jquery-3.5.1.slim.min.js"></script>
-    <script src="https://cdn.jsdelivr.net/npm/bootstrap@4.5.2/dist/js/bootstrap.bundle.min.js"></script>
-    """ + common_theme_css + """
-    <style>
-      body { padding-left: 20px; padding-right: 20px; }
-      .container { max-width: 500px; margin-top: 50px; background: rgba(255,255,255,0.95); padding: 30px; border-radius: 15px; box-shadow: 0 8px 20px rgba(0,0,0,0.1); }
-    </style>
-  </head>
-  <body class="{{ session.theme }}">
-    """ + nav_html + """
-    <div class="container">
-      <h1 class="mb-4 text-center"><i class="fas fa-user-plus"></i> Register</h1>
-      <form method="POST" action="/register">
-        <div class="form-group">
-          <label>Email</label>
-          <input type="email" name="email" required class="form-control">
-        </div>
-        <div class="form-group">
-          <label>Password</label>
-          <input type="password" name="password" required class="form-control">
-        </div>
-        <div class="form-group">
-          <label>Confirm Password</label>
-          <input type="password" name="confirm_password" required class="form-control">
-        </div>
-        <div class="form-group">
-          <label>Birth Date</label>
-          <input type="date" name="birth_date" required class="form-control">
-        </div>
-        <div class="form-group">
-          <label>Birth Place</label>
-          <input type="text" name="birth_place" required class="form-control">
-        </div>
-        <div class="form-group">
-          <label>Father's Full Name</label>
-          <input type="text" name="father_name" required class="form-control">
-        </div>
-        <div class="form-group">
-          <label>Mother's Full Name</label>
-          <input type="text" name="mother_name" required class="form-control">
-        </div>
-        <button type="submit" class="btn btn-primary"><i class="fas fa-check"></i> Create Account</button>
-      </form>
-    </div>
-  </body>
-</html>
-"""
-
-forgot_template = """
-<!doctype html>
-<html>
-  <head>
-    """ + meta_head + """
-    <title>Forgot Password</title>
-    <link rel="stylesheet" href="https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css">
-    <script src="https://code.jquery.com/jquery-3.5.1.slim.min.js"></script>
-    <script src="https://cdn.jsdelivr.net/npm/bootstrap@4.5.2/dist/js/bootstrap.bundle.min.js"></script>
-    """ + common_theme_css + """
-    <style>
-      body { padding-left: 20px; padding-right: 20px; }
-      .container { max-width: 500px; margin-top: 50px; background: rgba(255,255,255,0.95); padding: 30px; border-radius: 15px; box-shadow: 0 8px 20px rgba(0,0,0,0.1); }
-    </style>
-  </head>
-  <body class="{{ session.theme }}">
-    """ + nav_html + """
-    <div class="container">
-      <h1 class="mb-4 text-center"><i class="fas fa-unlock-alt"></i> Forgot Password</h1>
-      <p>Please enter your email, as well as your father's and mother's full names to verify your identity.</p>
-      <form method="POST" action="/forgot_password">
-        <div class="form-group">
-          <label>Email</label>
-          <input type="email" name="email" required class="form-control">
-        </div>
-        <div class="form-group">
-          <label>Father's Full Name</label>
-          <input type="text" name="father_name" required class="form-control">
-        </div>
-        <div class="form-group">
-          <label>Mother's Full Name</label>
-          <input type="text" name="mother_name" required class="form-control">
-        </div>
-        <div class="form-group">
-          <label>New Password</label>
-          <input type="password" name="new_password" required class="form-control">
-        </div>
-        <div class="form-group">
-          <label>Confirm New Password</label>
-          <input type="password" name="confirm_password" required class="form-control">
-        </div>
-        <button type="submit" class="btn btn-primary"><i class="fas fa-check"></i> Reset</button>
-      </form>
-    </div>
-  </body>
-</html>
-"""
-
-change_template = """
-<!doctype html>
-<html>
-  <head>
-    """ + meta_head + """
-    <title>Change Password</title>
-    <link rel="stylesheet" href="https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css">
-    <script src="https://code.jquery.com/jquery-3.5.1.slim.min.js"></script>
-    <script src="https://cdn.jsdelivr.net/npm/bootstrap@4.5.2/dist/js/bootstrap.bundle.min.js"></script>
-    """ + common_theme_css + """
-    <style>
-      body { padding-left: 20px; padding-right: 20px; }
-      .container { max-width: 500px; margin-top: 50px; background: rgba(255,255,255,0.95); padding: 30px; border-radius: 15px; box-shadow: 0 8px 20px rgba(0,0,0,0.1); }
-    </style>
-  </head>
-  <body class="{{ session.theme }}">
-    """ + nav_html + """
-    <div class="container">
-      <h1 class="mb-4 text-center"><i class="fas fa-key"></i> Change Password</h1>
-      <form method="POST" action="/change_password">
-        <div class="form-group">
-          <label>Old Password</label>
-          <input type="password" name="old_password" required class="form-control">
-        </div>
-        <div class="form-group">
-          <label>New Password</label>
-          <input type="password" name="new_password" required class="form-control">
-        </div>
-        <div class="form-group">
-          <label>Confirm New Password</label>
-          <input type="password" name="confirm_password" required class="form-control">
-        </div>
-        <button type="submit" class="btn btn-primary"><i class="fas fa-check"></i> Change</button>
-      </form>
-    </div>
-  </body>
-</html>
-"""
-
-activation_template = """
-<!doctype html>
-<html lang="en">
-  <head>
-    """ + meta_head + """
-    <meta name="viewport" content="width=device-width, initial-scale=1, maximum-scale=1, user-scalable=no">
-    <title>Plan Activation</title>
-    <link rel="stylesheet" href="https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css">
-    """ + common_theme_css + """
-    <style>
-      body { padding-left: 20px; padding-right: 20px; }
-      .activation-email { font-weight: bold; }
-      .nav-tabs .nav-link { font-size: 1.1em; }
-      .tab-content { margin-top: 20px; }
-      .card { background: rgba(255,255,255,0.95); backdrop-filter: blur(5px); }
-      .activation-footer { margin-top: 30px; text-align: center; font-size: 0.9em; color: #343a40; }
-    </style>
-  </head>
-  <body class="{{ session.theme }}">
-    <div class="container mt-4">
-      <h2 class="text-center">Plan Activation</h2>
-      <div class="text-center mb-3">
-          <p>Your activation email is: <span class="activation-email">{{ email }}</span></p>
-      </div>
-      <ul class="nav nav-tabs justify-content-center" id="activationTab" role="tablist">
-        <li class="nav-item">
-          <a class="nav-link active" id="payment-tab" data-toggle="tab" href="#payment" role="tab" aria-controls="payment" aria-selected="true">
-            <i class="fas fa-credit-card"></i> Activation by Payment
-          </a>
-        </li>
-        <li class="nav-item">
-          <a class="nav-link" id="key-tab" data-toggle="tab" href="#key" role="tab" aria-controls="key" aria-selected="false">
-            <i class="fas fa-key"></i> Activation by Key
-          </a>
-        </li>
-        <li class="nav-item">
-          <a class="nav-link" id="myemail-tab" data-toggle="tab" href="#myemail" role="tab" aria-controls="myemail" aria-selected="false">
-            <i class="fas fa-envelope"></i> My Activation Email
-          </a>
-        </li>
-      </ul>
-      <div class="tab-content" id="activationTabContent">
-        <div class="tab-pane fade show active" id="payment" role="tabpanel" aria-labelledby="payment-tab">
-          <div class="card">
-            <div class="card-body">
-              <h4 class="card-title">Activation by Payment</h4>
-              <p class="card-text">To activate a paid plan, please go to the <a href="{{ url_for('choose_plan') }}">Choose a Plan</a> page.</p>
-            </div>
-          </div>
-        </div>
-        <div class="tab-pane fade" id="key" role="tabpanel" aria-labelledby="key-tab">
-          <div class="card">
-            <div class="card-body">
-              <h4 class="card-title">Activation by Key</h4>
-              <form method="POST" action="{{ url_for('activate_key') }}">
-                <div class="form-group">
-                  <label for="activation_key">Enter your activation key:</label>
-                  <input type="text" name="activation_key" id="activation_key" class="form-control" required>
-                </div>
-                <button type="submit" class="btn btn-primary">Validate Key</button>
-              </form>
-            </div>
-          </div>
-        </div>
-        <div class="tab-pane fade" id="myemail" role="tabpanel" aria-labelledby="myemail-tab">
-          <div class="card">
-            <div class="card-body">
-              <h4 class="card-title">My Activation Email</h4>
-              <p>Your activation email is: <span class="activation-email">{{ email }}</span></p>
-            </div>
-          </div>
-        </div>
-      </div>
-      <div class="activation-footer">
-        SASTOUKA DIGITAL © 2025 sastoukadigital@gmail.com • Whatsapp +212652084735
-      </div>
-    </div>
-    <script src="https://code.jquery.com/jquery-3.5.1.slim.min.js"></script>
-    <script src="https://cdn.jsdelivr.net/npm/bootstrap@4.5.2/dist/js/bootstrap.bundle.min.js"></script>
-  </body>
-</html>
-"""
+# Quelques séries tirées d'avance par (opération, niveau, nombre) ; chaque série n'est servie
+# qu'une fois et le thread de fond en retire une nouvelle aussitôt
+EXERCISE_POOL_MAX_KEYS = 64
+EXERCISE_POOL_OPERATIONS = ("addition", "subtraction", "multiplication", "division")
+EXERCISE_POOL_BATCHES = 2
+_exercise_pool = OrderedDict()
+_exercise_pool_lock = threading.Lock()
+_exercise_pool_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="exercise-pool")
+# Générateur réservé au thread de fond (un Generator NumPy ne se partage pas entre threads)
+_prefetch_rng = np.random.default_rng()
+
+def refill_exercise_pool(key):
+    operation, level, n = key
+    with _exercise_pool_lock:
+        batches = _exercise_pool.get(key)
+        if batches is not None and len(batches) >= EXERCISE_POOL_BATCHES:
+            return
+    batch = generate_exercises(operation, level, n, rng=_prefetch_rng)
+    with _exercise_pool_lock:
+        batches = _exercise_pool.get(key)
+        if batches is None:
+            batches = _exercise_pool[key] = deque()
+            if len(_exercise_pool) > EXERCISE_POOL_MAX_KEYS:
+                _exercise_pool.popitem(last=False)
+        if len(batches) < EXERCISE_POOL_BATCHES:
+            batches.append(batch)
+
+def get_exercises(operation, level, n):
+    # Seules les tailles proposées par le formulaire passent par le pool : une autre taille est
+    # générée à la demande, sans série gardée en réserve
+    if n not in NB_OPS_CHOICES or level not in ADD_SUB_RANGES or operation not in EXERCISE_POOL_OPERATIONS:
+        return generate_exercises(operation, level, n)
+    key = (operation, level, n)
+    with _exercise_pool_lock:
+        batches = _exercise_pool.get(key)
+        batch = batches.popleft() if batches else None
+        if batches is not None:
+            _exercise_pool.move_to_end(key)
+    if batch is None:
+        batch = generate_exercises(operation, level, n)
+    _exercise_pool_executor.submit(refill_exercise_pool, key)
+    return batch
+
+def prefetch_default_exercises():
+    # Valeur par défaut du formulaire : 100 opérations, pour chaque catégorie et niveau
+    for operation in EXERCISE_POOL_OPERATIONS:
+        for level in ADD_SUB_RANGES:
+            for _ in range(EXERCISE_POOL_BATCHES):
+                _exercise_pool_executor.submit(refill_exercise_pool, (operation, level, 100))
+
+prefetch_default_exercises()
 
 # ------------------------------
 # Fonctions de gestion des plans et activation
 # ------------------------------
+BASE36_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+# Puissances de 36 couvrant un condensat SHA-256 (36**50 > 2**256)
+BASE36_POWERS = [36 ** i for i in range(51)]
+
+# Clé déterministe pour (email, plan, secret, jour) : les essais répétés dans la journée ne refont pas le calcul
+@functools.lru_cache(maxsize=256)
 def generate_activation_key(email, plan, secret, date_str):
     data = f"{email.lower()}_{plan}_{secret}_{date_str}"
-    hash_hex = hashlib.sha256(data.encode()).hexdigest()
-    num = int(hash_hex, 16)
-    alphabet = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
-    key_base36 = ""
-    while num > 0:
+    num = int.from_bytes(hashlib.sha256(data.encode()).digest(), "big")
+    # Seuls les 16 chiffres base36 de poids fort sont conservés : on retire d'abord les chiffres
+    # de poids faible en une division, puis on convertit un entier de 16 chiffres au plus
+    n_digits = bisect.bisect_right(BASE36_POWERS, num)
+    if n_digits > 16:
+        num //= BASE36_POWERS[n_digits - 16]
+    digits = []
+    for _ in range(16):
         num, rem = divmod(num, 36)
-        key_base36 = alphabet[rem] + key_base36
-    key_base36 = key_base36.zfill(16)
-    activation_key = key_base36[:16]
+        digits.append(BASE36_ALPHABET[rem])
+    activation_key = "".join(reversed(digits))
     formatted_key = "-".join([activation_key[i:i+4] for i in range(0, len(activation_key), 4)])
     return formatted_key
 
 ACTIVATION_TOKEN = os.environ.get("ACTIVATION_TOKEN", "1r2h3y4f7e5dsf6")
 
-def can_use_plan(email, level):
-    user_data = users[email]
-    usage_count = user_data.setdefault("usage_count", {"easy": 0, "intermediate": 0, "hard": 0, "very hard": 0, "expert": 0, "total": 0})
+LEVELS = ("easy", "intermediate", "hard", "very hard", "expert")
+
+# Durée de validité de l'abonnement mensuel
+MONTHLY_PLAN_DURATION = timedelta(days=30)
+
+def can_use_plan(user_data, level):
+    usage_count = user_data["usage_count"]
     if user_data["plan"] == "free":
-        return usage_count.get(level, 0) < 1
+        return usage_count[level] < 1
     elif user_data["plan"] == "monthly":
         return True
     elif user_data["plan"] == "twenty":
         return usage_count["total"] < 20
     return False
 
-def track_usage(email, level):
-    user_data = users[email]
-    usage_count = user_data.setdefault("usage_count", {"easy": 0, "intermediate": 0, "hard": 0, "very hard": 0, "expert": 0, "total": 0})
+def plan_status(user_data):
+    # Accès aux cinq niveaux en une seule passe sur le plan (page de sélection)
+    usage_count = user_data["usage_count"]
+    plan = user_data["plan"]
+    if plan == "free":
+        return {lvl: usage_count[lvl] < 1 for lvl in LEVELS}
+    elif plan == "monthly":
+        return dict.fromkeys(LEVELS, True)
+    elif plan == "twenty":
+        return dict.fromkeys(LEVELS, usage_count["total"] < 20)
+    return dict.fromkeys(LEVELS, False)
+
+def track_usage(user_data, level):
+    usage_count = user_data["usage_count"]
     plan = user_data["plan"]
     if plan == "free":
         usage_count[level] += 1
@@ -946,18 +466,79 @@ def get_local_ip():
         s.close()
     return local_ip
 
+# Adresse affichée dans le pied de page, résolue une seule fois au démarrage
+HOST_ADDRESS = f"{get_local_ip()}:5500"
+
 # ------------------------------
 # Configuration de l'application Flask et des hooks
 # ------------------------------
 app = Flask(__name__)
 app.secret_key = os.environ.get("07ffda66dd44daf06c10bc672b47f0b0eaff1f2fade1034e3bfdb57c4dcb7cc8", secrets.token_hex(32))
+# Bytecode des templates conservé sur disque (.jinja_cache, rempli au déploiement par
+# scripts/precompile_templates.py) : un redémarrage de worker recharge le code compilé
+# au lieu de réanalyser les fichiers (doit précéder le premier accès à jinja_env)
+os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+app.jinja_options = {**app.jinja_options, "bytecode_cache": FileSystemBytecodeCache(JINJA_CACHE_DIR)}
+# Fichiers statiques (CSS/JS communs) mis en cache un an par le navigateur ; le paramètre v
+# ne change que si leur contenu change (déploiement), pas à chaque redémarrage de worker
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 31536000
+# Pas de vérification de la date des fichiers de templates à chaque rendu (même en mode debug)
+app.config["TEMPLATES_AUTO_RELOAD"] = False
+VERSIONED_STATIC_FILES = ("css/theme.css", "js/theme.js")
+
+def compute_static_version():
+    digest = hashlib.blake2b(digest_size=8)
+    for filename in VERSIONED_STATIC_FILES:
+        with open(os.path.join(app.static_folder, filename), "rb") as fh:
+            digest.update(fh.read())
+    return digest.hexdigest()
+
+STATIC_VERSION = compute_static_version()
+# Compression gzip des réponses texte et PDF au-delà de 1 Ko ; les pages rendues en flux
+# (stream_page) ne sont pas compressées pour rester envoyées au fil du rendu
+app.config["COMPRESS_MIMETYPES"] = ["text/html", "text/css", "application/javascript", "application/json", "application/pdf"]
+app.config["COMPRESS_MIN_SIZE"] = 1024
+app.config["COMPRESS_LEVEL"] = 6
+app.config["COMPRESS_STREAMS"] = False
+if Compress is not None:
+    Compress(app)
+
+@app.context_processor
+def inject_static_version():
+    return {"static_version": STATIC_VERSION}
+
+# Compilation de tous les templates au démarrage : aucune requête n'a plus à analyser
+# un fichier, les templates compilés restent dans le cache de l'environnement Jinja
+def precompile_templates():
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+precompile_templates()
+
+# Nombre de fragments Jinja regroupés par envoi lors d'un rendu en flux
+STREAM_BUFFER_SIZE = 200
+
+def stream_page(template_name, **context):
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(STREAM_BUFFER_SIZE)
+    return Response(stream_with_context(stream), mimetype="text/html")
+
+# Doit rester le premier hook : les suivants lisent users
+@app.before_request
+def load_users_once():
+    ensure_users_loaded()
+    refresh_users_if_stale()
+
+VALID_THEMES = frozenset(('blue', 'pink', 'green', 'yellow', 'kid_friendly'))
 
 @app.before_request
 def check_theme():
     theme = request.args.get('theme')
-    if theme in ['blue', 'pink', 'green', 'yellow', 'kid_friendly']:
+    if theme in VALID_THEMES:
         session['theme'] = theme
-        if "user" in session:
+        # Sauvegarde planifiée seulement si le thème enregistré change réellement
+        if "user" in session and users[session["user"]].get("theme") != theme:
             users[session["user"]]["theme"] = theme
             mark_users_dirty()
     elif "theme" not in session:
@@ -970,19 +551,17 @@ def check_theme():
 def check_remember_me():
     if "user" not in session:
         token = request.cookies.get("remember_token")
-        if token:
-            for email, data in users.items():
-                if data.get("remember_token") == token:
-                    session["user"] = email
-                    break
+        email = _token_to_email.get(token) if token else None
+        if email:
+            session["user"] = email
 
 @app.route("/set_theme/<theme>")
 def set_theme(theme):
-    if theme not in ['blue', 'pink', 'green', 'yellow', 'kid_friendly']:
+    if theme not in VALID_THEMES:
         flash("Invalid theme", "warning")
         return redirect(request.referrer or "/")
     session['theme'] = theme
-    if "user" in session:
+    if "user" in session and users[session["user"]].get("theme") != theme:
         users[session["user"]]["theme"] = theme
         mark_users_dirty()
     flash(f"Theme changed to {theme}", "success")
@@ -991,9 +570,27 @@ def set_theme(theme):
 # ------------------------------
 # Routes principales de l'application
 # ------------------------------
-latest_exercises = None
-latest_meta = None
-latest_result = None
+# Dernière série générée, ses paramètres et le dernier résultat, par utilisateur :
+# la correction et le PDF relisent les exercices côté serveur. Seuls les utilisateurs les plus
+# récemment actifs sont gardés ; l'état d'un utilisateur est retiré à sa déconnexion
+USER_STATES_MAX = 1000
+user_exercise_states = OrderedDict()
+_user_states_lock = threading.Lock()
+
+def user_state(email):
+    with _user_states_lock:
+        state = user_exercise_states.get(email)
+        if state is None:
+            state = user_exercise_states[email] = {"exercises": None, "meta": None, "result": None, "series_id": None}
+            while len(user_exercise_states) > USER_STATES_MAX:
+                user_exercise_states.popitem(last=False)
+        else:
+            user_exercise_states.move_to_end(email)
+        return state
+
+def drop_user_state(email):
+    with _user_states_lock:
+        user_exercise_states.pop(email, None)
 
 @app.route("/", methods=["GET"])
 def index_get():
@@ -1003,79 +600,87 @@ def index_get():
     user_data = users[email]
     if "plan" not in user_data:
         return redirect("/choose_plan")
-    if user_data["plan"] == "monthly":
-        start = user_data["plan_start"]
-        if datetime.now() > (start + timedelta(days=30)):
+    plan = user_data["plan"]
+    plan_start_str = ""
+    plan_end_str = ""
+    if plan == "monthly":
+        # Date de fin calculée une fois, pour le test d'expiration comme pour l'affichage
+        plan_start = user_data["plan_start"]
+        plan_end = plan_start + MONTHLY_PLAN_DURATION
+        if datetime.now() > plan_end:
             flash("Your monthly subscription has expired. Please choose a new plan.", "warning")
             user_data.pop("plan", None)
             user_data.pop("plan_start", None)
             mark_users_dirty()
             return redirect("/choose_plan")
-    if user_data["plan"] == "free":
-        usage_count = user_data.setdefault("usage_count", {"easy": 0, "intermediate": 0, "hard": 0, "very hard": 0, "expert": 0, "total": 0})
-        levels = ["easy", "intermediate", "hard", "very hard", "expert"]
-        all_exhausted = all(usage_count.get(lvl, 0) >= 1 for lvl in levels)
-        if all_exhausted:
-            flash("Your free trial is exhausted. Please choose another plan.", "warning")
-            return redirect("/choose_plan")
-    usage_count = user_data.setdefault("usage_count", {"easy": 0, "intermediate": 0, "hard": 0, "very hard": 0, "expert": 0, "total": 0})
-    host_address = f"{get_local_ip()}:5500"
-    levels = ["easy", "intermediate", "hard", "very hard", "expert"]
-    can_use_dict = {lvl: can_use_plan(email, lvl) for lvl in levels}
-    plan_start_str = ""
-    plan_end_str = ""
-    if user_data["plan"] == "monthly":
-        plan_start_str = user_data["plan_start"].strftime("%Y-%m-%d")
-        plan_end_str = (user_data["plan_start"] + timedelta(days=30)).strftime("%Y-%m-%d")
-    return render_template_string(selection_template,
-                                  session=session,
-                                  user_plan=user_data["plan"],
-                                  usage_count=usage_count,
-                                  plan_start=plan_start_str,
-                                  plan_end=plan_end_str,
-                                  host_address=host_address,
-                                  can_use=can_use_dict)
+        plan_start_str = plan_start.strftime("%Y-%m-%d")
+        plan_end_str = plan_end.strftime("%Y-%m-%d")
+    usage_count = user_data["usage_count"]
+    can_use_dict = plan_status(user_data)
+    # Essai gratuit épuisé : plus aucun niveau accessible
+    if plan == "free" and not any(can_use_dict.values()):
+        flash("Your free trial is exhausted. Please choose another plan.", "warning")
+        return redirect("/choose_plan")
+    return render_template("selection.html",
+                           session=session,
+                           user_plan=plan,
+                           usage_count=usage_count,
+                           plan_start=plan_start_str,
+                           plan_end=plan_end_str,
+                           host_address=HOST_ADDRESS,
+                           can_use=can_use_dict)
 
 @app.route("/", methods=["POST"])
 def index_post():
     if "user" not in session:
         return redirect("/login")
     email = session["user"]
-    if "plan" not in users[email]:
+    user_data = users[email]
+    if "plan" not in user_data:
         return redirect("/choose_plan")
     phase = request.form.get("phase")
     if phase == "generate":
         level = request.form.get("level")
-        if not can_use_plan(email, level):
+        if not can_use_plan(user_data, level):
             flash("You have exhausted your uses for this level.", "danger")
             return redirect("/")
-        track_usage(email, level)
+        # Nombre d'opérations vérifié avant de décompter l'utilisation du niveau
+        try:
+            nb_ops = int(request.form.get("nb_ops", 100))
+        except ValueError:
+            nb_ops = None
+        if nb_ops not in NB_OPS_CHOICES:
+            flash("Invalid number of operations.", "danger")
+            return redirect("/")
+        track_usage(user_data, level)
         selected_category = request.form.get("category")
         theme = session.get("theme", "blue")
-        nb_ops = int(request.form.get("nb_ops", 100))
         pdf_columns = int(request.form.get("pdf_columns", 3))
-        global latest_exercises, latest_meta, latest_result
-        latest_meta = {"level": level,
-                       "selected_category": selected_category,
-                       "theme": theme,
-                       "nb_ops": nb_ops,
-                       "pdf_columns": pdf_columns}
+        state = user_state(email)
+        state["meta"] = {"level": level,
+                         "selected_category": selected_category,
+                         "theme": theme,
+                         "nb_ops": nb_ops,
+                         "pdf_columns": pdf_columns}
         if selected_category == "all":
             operations = ["addition", "subtraction", "multiplication", "division"]
         else:
             operations = [selected_category]
         exercises = {}
         for op in operations:
-            exercises[op] = [generate_exercise(op, level) for _ in range(nb_ops)]
-        latest_exercises = exercises
-        latest_result = None
-        host_address = f"{get_local_ip()}:5500"
-        return render_template_string(exercise_template,
-                                      exercises=exercises,
-                                      level=level,
-                                      selected_category=selected_category,
-                                      host_address=host_address,
-                                      session=session)
+            exercises[op] = get_exercises(op, level, nb_ops)
+        state["exercises"] = exercises
+        state["result"] = None
+        # Identifiant de la série, renvoyé par le formulaire de réponses pour vérifier qu'il s'agit bien d'elle
+        state["series_id"] = secrets.token_hex(8)
+        # Page envoyée par morceaux : l'en-tête part avant la fin de la boucle sur les exercices
+        return stream_page("exercise.html",
+                           exercises=exercises,
+                           series_id=state["series_id"],
+                           level=level,
+                           selected_category=selected_category,
+                           host_address=HOST_ADDRESS,
+                           session=session)
     return redirect("/")
 
 @app.route("/choose_plan", methods=["GET", "POST"])
@@ -1084,54 +689,51 @@ def choose_plan():
         return redirect("/login")
     email = session["user"]
     user_data = users[email]
-    free_disabled = False
-    if "usage_count" in user_data:
-        levels = ["easy", "intermediate", "hard", "very hard", "expert"]
-        free_disabled = all(user_data["usage_count"].get(lvl, 0) >= 1 for lvl in levels)
+    usage_count = user_data["usage_count"]
+    free_disabled = not any(usage_count[lvl] < 1 for lvl in LEVELS)
     if request.method == "POST":
         plan = request.form.get("plan")
         if plan in ("monthly", "twenty"):
             return redirect(url_for("purchase_plan", plan=plan))
         if plan not in ("free", "monthly", "twenty"):
             flash("Invalid plan.", "danger")
-            return render_template_string(choose_plan_template, session=session, free_disabled=free_disabled)
+            return render_template("choose_plan.html", session=session, free_disabled=free_disabled)
         if plan == "free" and free_disabled:
             flash("Your free trial is exhausted. Please choose another plan.", "warning")
-            return render_template_string(choose_plan_template, session=session, free_disabled=True)
+            return render_template("choose_plan.html", session=session, free_disabled=True)
         user_data["plan"] = plan
-        user_data.setdefault("usage_count", {"easy": 0, "intermediate": 0, "hard": 0, "very hard": 0, "expert": 0, "total": 0})
         mark_users_dirty()
         flash("Plan successfully saved.", "success")
         return redirect("/")
-    return render_template_string(choose_plan_template, session=session, free_disabled=free_disabled)
+    return render_template("choose_plan.html", session=session, free_disabled=free_disabled)
 
 @app.route("/activation")
 def activation():
     if "user" not in session:
         return redirect("/login")
     email = session["user"]
-    return render_template_string(activation_template, email=email)
+    return render_template("activation.html", email=email)
 
 @app.route("/activate_key", methods=["POST"])
 def activate_key():
     if "user" not in session:
         return redirect("/login")
-    activation_key_input = request.form.get("activation_key")
+    # Comparaison en temps constant ; la seconde clé n'est calculée que si la première échoue
+    activation_key_input = request.form.get("activation_key", "").encode("utf-8")
     email = session["user"]
     today = datetime.now().strftime("%Y%m%d")
     expected_key_monthly = generate_activation_key(email, "monthly", ACTIVATION_TOKEN, today)
-    expected_key_twenty = generate_activation_key(email, "twenty", ACTIVATION_TOKEN, today)
-    if activation_key_input == expected_key_monthly:
+    if hmac.compare_digest(activation_key_input, expected_key_monthly.encode("utf-8")):
         update_activation_after_payment("monthly")
         flash("Activation key valid! Your monthly plan is activated.", "success")
         return redirect(url_for("index_get"))
-    elif activation_key_input == expected_key_twenty:
+    expected_key_twenty = generate_activation_key(email, "twenty", ACTIVATION_TOKEN, today)
+    if hmac.compare_digest(activation_key_input, expected_key_twenty.encode("utf-8")):
         update_activation_after_payment("twenty")
         flash("Activation key valid! Your 20-tries plan is activated.", "success")
         return redirect(url_for("index_get"))
-    else:
-        flash("Invalid activation key.", "danger")
-        return redirect(url_for("activation"))
+    flash("Invalid activation key.", "danger")
+    return redirect(url_for("activation"))
 
 def update_activation_after_payment(plan):
     email = session["user"]
@@ -1157,21 +759,59 @@ PAYPAL_SECRET = os.environ.get("PAYPAL_SECRET") or "EKSvwa_yK7ZYTuq45VP60dbRMzCh
 PAYPAL_OAUTH_URL = "https://api-m.paypal.com/v1/oauth2/token"
 PAYPAL_ORDER_API = "https://api-m.paypal.com/v2/checkout/orders"
 
+# Session HTTP partagée : la connexion TLS vers api-m.paypal.com est réutilisée d'un appel à l'autre.
+# Seuls les échecs de connexion sont retentés (aucune requête POST n'est rejouée après envoi)
+paypal_session = requests.Session()
+paypal_session.mount("https://api-m.paypal.com", HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                                                             max_retries=Retry(total=2, read=0, backoff_factor=0.2)))
+# L'obtention d'un jeton n'a pas d'effet de bord : elle est aussi retentée sur les erreurs passerelle
+paypal_session.mount("https://api-m.paypal.com/v1/oauth2/", HTTPAdapter(max_retries=Retry(total=2, backoff_factor=0.2,
+                                                                                          status_forcelist=(502, 503, 504),
+                                                                                          allowed_methods=None,
+                                                                                          raise_on_status=False)))
+# (connexion, lecture) en secondes : un PayPal lent ne bloque pas indéfiniment un thread du worker
+PAYPAL_TIMEOUT = (3.05, 10)
+
+# Jeton OAuth réutilisé jusqu'à PAYPAL_TOKEN_MARGIN secondes avant son expiration
+PAYPAL_TOKEN_MARGIN = 60
+_paypal_token = {"token": None, "expires_at": 0.0}
+_paypal_token_lock = threading.Lock()
+
 def get_paypal_access_token():
-    response = requests.post(
-        PAYPAL_OAUTH_URL,
-        headers={"Accept": "application/json", "Accept-Language": "en_US"},
-        data={"grant_type": "client_credentials"},
-        auth=(PAYPAL_CLIENT_ID, PAYPAL_SECRET)
-    )
-    if response.status_code == 200:
-        return response.json()["access_token"]
-    else:
-        raise Exception(f"Error obtaining PayPal token: {response.status_code} {response.text}")
+    with _paypal_token_lock:
+        if time.time() < _paypal_token["expires_at"] - PAYPAL_TOKEN_MARGIN:
+            return _paypal_token["token"]
+        response = paypal_session.post(
+            PAYPAL_OAUTH_URL,
+            headers={"Accept": "application/json", "Accept-Language": "en_US"},
+            data={"grant_type": "client_credentials"},
+            auth=(PAYPAL_CLIENT_ID, PAYPAL_SECRET),
+            timeout=PAYPAL_TIMEOUT
+        )
+        if response.status_code == 200:
+            data = response.json()
+            _paypal_token["token"] = data["access_token"]
+            _paypal_token["expires_at"] = time.time() + data.get("expires_in", 0)
+            return _paypal_token["token"]
+        else:
+            raise Exception(f"Error obtaining PayPal token: {response.status_code} {response.text}")
+
+def invalidate_paypal_token():
+    with _paypal_token_lock:
+        _paypal_token["expires_at"] = 0.0
+
+def paypal_post(url, **kwargs):
+    # Un 401 signale un jeton révoqué ou expiré côté PayPal : nouveau jeton et un seul nouvel essai
+    for attempt in range(2):
+        token = get_paypal_access_token()
+        headers = {"Content-Type": "application/json", "Authorization": f"Bearer {token}"}
+        response = paypal_session.post(url, headers=headers, timeout=PAYPAL_TIMEOUT, **kwargs)
+        if response.status_code != 401:
+            break
+        invalidate_paypal_token()
+    return response
 
 def create_paypal_order(amount, currency="USD"):
-    token = get_paypal_access_token()
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {token}"}
     body = {
         "intent": "CAPTURE",
         "purchase_units": [{"amount": {"currency_code": currency, "value": amount}}],
@@ -1181,7 +821,7 @@ def create_paypal_order(amount, currency="USD"):
             "landing_page": "BILLING"
         }
     }
-    response = requests.post(PAYPAL_ORDER_API, json=body, headers=headers)
+    response = paypal_post(PAYPAL_ORDER_API, json=body)
     if response.status_code in (200, 201):
         data = response.json()
         order_id = data["id"]
@@ -1195,10 +835,7 @@ def create_paypal_order(amount, currency="USD"):
         raise Exception(f"Error creating PayPal order: {response.status_code} {response.text}")
 
 def capture_paypal_order(order_id):
-    token = get_paypal_access_token()
-    url = f"{PAYPAL_ORDER_API}/{order_id}/capture"
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {token}"}
-    response = requests.post(url, headers=headers)
+    response = paypal_post(f"{PAYPAL_ORDER_API}/{order_id}/capture")
     if response.status_code in (200, 201):
         data = response.json()
         if data.get("status") == "COMPLETED":
@@ -1206,7 +843,28 @@ def capture_paypal_order(order_id):
         return False
     return False
 
-purchase_orders = {}
+# Commandes PayPal en attente (order_id -> (plan, date de création)) : bornées en taille et en durée,
+# retirées dès le retour de PayPal (succès ou annulation)
+PURCHASE_ORDER_TTL = 3600
+PURCHASE_ORDERS_MAX = 10000
+purchase_orders = OrderedDict()
+_purchase_orders_lock = threading.Lock()
+
+def remember_purchase_order(order_id, plan):
+    now = time.monotonic()
+    with _purchase_orders_lock:
+        # Les plus anciennes en tête : on purge les commandes expirées ou en surnombre
+        while purchase_orders and (len(purchase_orders) >= PURCHASE_ORDERS_MAX
+                                   or now - next(iter(purchase_orders.values()))[1] > PURCHASE_ORDER_TTL):
+            purchase_orders.popitem(last=False)
+        purchase_orders[order_id] = (plan, now)
+
+def pop_purchase_order(order_id):
+    with _purchase_orders_lock:
+        entry = purchase_orders.pop(order_id, None)
+    if entry is None or time.monotonic() - entry[1] > PURCHASE_ORDER_TTL:
+        return None
+    return entry[0]
 
 @app.route("/purchase_plan/<plan>")
 def purchase_plan(plan):
@@ -1218,7 +876,7 @@ def purchase_plan(plan):
     amount = "10.00" if plan == "monthly" else "5.00"
     try:
         order_id, approval_url = create_paypal_order(amount, "USD")
-        purchase_orders[order_id] = plan
+        remember_purchase_order(order_id, plan)
         return redirect(approval_url)
     except Exception as e:
         return f"Error: {e}"
@@ -1230,7 +888,7 @@ def paypal_success():
         return "Missing 'token' parameter in URL."
     success = capture_paypal_order(order_id)
     if success:
-        plan = purchase_orders.get(order_id)
+        plan = pop_purchase_order(order_id)
         if plan:
             update_activation_after_payment(plan)
             flash(f"Payment validated for the {plan} plan!", "success")
@@ -1243,27 +901,91 @@ def paypal_success():
 
 @app.route("/paypal_cancel")
 def paypal_cancel():
+    # PayPal renvoie l'identifiant de la commande abandonnée dans le paramètre token
+    order_id = request.args.get("token")
+    if order_id:
+        pop_purchase_order(order_id)
     flash("Payment cancelled by the user.", "error")
     return redirect(url_for("index_get"))
 
 # ------------------------------
-# Génération et envoi du PDF (fichier temporaire uniquement en local)
+# Construction du PDF et cache des PDF produits
 # ------------------------------
+# Un même jeu d'exercices (et de colonnes) donne toujours le même PDF : les derniers produits
+# sont gardés en mémoire pour les téléchargements répétés
+PDF_CACHE_MAX = 16
+_pdf_cache = OrderedDict()
+_pdf_cache_lock = threading.Lock()
+
+def pdf_cache_key(exercises, pdf_columns):
+    payload = json.dumps(exercises, sort_keys=True).encode("utf-8") + str(pdf_columns).encode("utf-8")
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+# Le dessin FPDF est du Python pur qui garde le GIL : il tourne dans des processus séparés pour ne pas
+# bloquer les autres threads du worker (pool créé au premier PDF). Processus lancés par "spawn" et non
+# par fork : le worker est multi-thread (un verrou copié verrouillé bloquerait l'enfant), et l'enfant
+# n'importe que pdf_builder, sans les effets de bord de main
+PDF_POOL_WORKERS = max(1, min(4, os.cpu_count() or 1))
+# Lancé directement (python main.py), ce module est __main__ et chaque enfant "spawn" le ré-exécuterait
+# en entier : le PDF est alors construit dans le processus (sous gunicorn, main est un module importé)
+PDF_POOL_ENABLED = __name__ != "__main__"
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+def get_pdf_pool():
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            _pdf_pool = ProcessPoolExecutor(max_workers=PDF_POOL_WORKERS,
+                                            mp_context=multiprocessing.get_context("spawn"))
+        return _pdf_pool
+
+def shutdown_pdf_pool():
+    global _pdf_pool
+    with _pdf_pool_lock:
+        pool, _pdf_pool = _pdf_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+atexit.register(shutdown_pdf_pool)
+
+def render_exercises_pdf(exercises, pdf_columns):
+    if not PDF_POOL_ENABLED:
+        return build_exercises_pdf(exercises, pdf_columns)
+    try:
+        return get_pdf_pool().submit(build_exercises_pdf, exercises, pdf_columns).result()
+    except BrokenProcessPool as e:
+        # Processus du pool perdu : le pool est recréé à la demande suivante, ce PDF est construit ici
+        logger.error("PDF process pool broken: %s", e)
+        shutdown_pdf_pool()
+        return build_exercises_pdf(exercises, pdf_columns)
+
+def get_exercises_pdf(exercises, pdf_columns):
+    key = pdf_cache_key(exercises, pdf_columns)
+    with _pdf_cache_lock:
+        pdf_bytes = _pdf_cache.get(key)
+        if pdf_bytes is not None:
+            _pdf_cache.move_to_end(key)
+            return pdf_bytes
+    pdf_bytes = render_exercises_pdf(exercises, pdf_columns)
+    with _pdf_cache_lock:
+        _pdf_cache[key] = pdf_bytes
+        _pdf_cache.move_to_end(key)
+        while len(_pdf_cache) > PDF_CACHE_MAX:
+            _pdf_cache.popitem(last=False)
+    return pdf_bytes
+
 @app.route("/generate_pdf")
 def generate_pdf_route():
-    global latest_result, latest_exercises, latest_meta
+    if "user" not in session:
+        return redirect("/login")
+    state = user_state(session["user"])
+    latest_exercises, latest_meta, latest_result = state["exercises"], state["meta"], state["result"]
     if not latest_result:
         if not latest_exercises or not latest_meta:
             return "No result to convert to PDF.", 400
-        solutions = {}
-        for op, ex_list in latest_exercises.items():
-            solutions[op] = []
-            for ex in ex_list:
-                question_text = f"{ex['a']:3d} {ex['op']} {ex['b']:3d}"
-                solutions[op].append({"question": question_text, "solution": ex["result"]})
         latest_result = {
             "feedback": {},
-            "solutions": solutions,
             "score": 0,
             "theme": latest_meta["theme"],
             "level": latest_meta["level"],
@@ -1271,156 +993,67 @@ def generate_pdf_route():
             "exercises": latest_exercises,
             "pdf_columns": latest_meta["pdf_columns"]
         }
-    pdf_columns = latest_meta.get("pdf_columns", 3)
-    pdf = FPDF(orientation="P", unit="mm", format="A5")
-    pdf.set_margins(10, 10, 10)
-    pdf.set_auto_page_break(auto=True, margin=10)
-    pdf.add_page()
-    pdf.set_y(pdf.h / 2 - 20)
-    pdf.set_font("Arial", "B", 28)
-    pdf.cell(0, 10, "Math Exercises", ln=True, align="C")
-    pdf.ln(10)
-    pdf.set_font("Arial", "I", 20)
-    pdf.cell(0, 10, "by SASTOUKA DIGITAL", ln=True, align="C")
-    pdf.add_page()
-    pdf.set_font("Arial", "B", 18)
-    pdf.cell(0, 10, "Questions", ln=True, align="C")
-    pdf.ln(5)
-    col_width = (pdf.w - pdf.l_margin - pdf.r_margin) / pdf_columns
-    line_height = 6
-    box_height = 3 * line_height
-    exercise_categories = list(latest_result["exercises"].items())
-    for idx, (cat, ex_list) in enumerate(exercise_categories):
-        pdf.set_font("Arial", "B", 16)
-        pdf.cell(0, 10, cat.capitalize(), ln=True)
-        y = pdf.get_y()
-        x = pdf.l_margin
-        col = 0
-        for i, ex in enumerate(ex_list):
-            draw_exercise_box(pdf, i+1, ex, x, y, col_width, line_height, solution_text=None)
-            col += 1
-            if col == pdf_columns:
-                col = 0
-                x = pdf.l_margin
-                y += box_height + 4
-                if y + box_height > pdf.h - pdf.b_margin:
-                    pdf.add_page()
-                    y = pdf.t_margin
-            else:
-                x += col_width
-        if idx != len(exercise_categories) - 1:
-            pdf.add_page()
-    pdf.add_page()
-    pdf.set_font("Arial", "B", 18)
-    pdf.cell(0, 10, "Solutions", ln=True, align="C")
-    pdf.ln(5)
-    solution_categories = list(latest_result["solutions"].items())
-    for idx, (cat, sol_list) in enumerate(solution_categories):
-        pdf.set_font("Arial", "B", 16)
-        pdf.cell(0, 10, cat.capitalize(), ln=True)
-        y = pdf.get_y()
-        x = pdf.l_margin
-        col = 0
-        for i, sol in enumerate(sol_list):
-            parts = sol["question"].split()
-            ex = {"a": parts[0], "op": parts[1], "b": parts[2]}
-            draw_exercise_box(pdf, i+1, ex, x, y, col_width, line_height, solution_text=sol["solution"])
-            col += 1
-            if col == pdf_columns:
-                col = 0
-                x = pdf.l_margin
-                y += box_height + 4
-                if y + box_height > pdf.h - pdf.b_margin:
-                    pdf.add_page()
-                    y = pdf.t_margin
-            else:
-                x += col_width
-        if idx != len(solution_categories) - 1:
-            pdf.add_page()
-    # Stockage temporaire local dans le dossier pdf_files
-    pdf_folder = os.path.join(os.getcwd(), "pdf_files")
-    if not os.path.exists(pdf_folder):
-        os.makedirs(pdf_folder)
-    pdf_file_path = os.path.join(pdf_folder, "exercise_results.pdf")
-    pdf.output(pdf_file_path)
-    # Envoi du fichier PDF à l'utilisateur, sans le stocker sur GCS
-    return send_file(pdf_file_path, mimetype='application/pdf', as_attachment=True, download_name="exercise_results.pdf")
+        state["result"] = latest_result
+    pdf_bytes = get_exercises_pdf(latest_result["exercises"], latest_meta.get("pdf_columns", 3))
+    # Les octets sont renvoyés tels quels, sans copie dans un BytesIO intermédiaire
+    return Response(pdf_bytes, mimetype='application/pdf',
+                    headers={"Content-Disposition": "attachment; filename=exercise_results.pdf"})
 
 @app.route("/answers", methods=["POST"])
 def answers_route():
-    global latest_exercises, latest_result, latest_meta
     if "user" not in session:
         return redirect("/login")
-    level = request.form.get("level")
-    selected_category = request.form.get("selected_category")
     theme = request.form.get("theme")
+    state = user_state(session["user"])
+    latest_exercises, latest_meta = state["exercises"], state["meta"]
     if not latest_exercises or not latest_meta:
         flash("No exercise in progress.", "danger")
         return redirect("/")
+    # Réponses d'une autre série (second onglet, retour arrière, nouvelle génération) : pas de correction
+    if request.form.get("series_id") != state["series_id"]:
+        flash("These answers belong to a previous exercise series. Please start again.", "warning")
+        return redirect("/")
     feedback = {}
     total_correct = 0
     total_questions = 0
-    if selected_category == "all":
-        operations = ["addition", "subtraction", "multiplication", "division"]
-    else:
-        operations = [selected_category]
-    for op in operations:
+    # Les opérandes sont relus dans la série conservée côté serveur, pas dans le formulaire :
+    # seule la réponse est lue, une fois par question, dans un formulaire résolu une seule fois
+    form = request.form
+    for op, ex_list in latest_exercises.items():
         feedback[op] = []
-        op_keys = [key for key in request.form.keys() if key.startswith(f"{op}_") and key.endswith("_a")]
-        nb_ops = len(op_keys)
-        for i in range(nb_ops):
-            user_answer = request.form.get(f"{op}_{i}")
+        prefix = op + "_"
+        for i, ex in enumerate(ex_list):
+            user_answer = form.get(prefix + str(i))
             if user_answer is None or user_answer.strip() == "":
-                user_answer = "Not answered"
+                user_answer = None
             else:
                 try:
                     user_answer = int(user_answer)
                 except:
-                    user_answer = "Not answered"
-            a = int(request.form.get(f"{op}_{i}_a"))
-            b = int(request.form.get(f"{op}_{i}_b"))
-            op_symbol = request.form.get(f"{op}_{i}_op")
-            if op_symbol == '+':
-                correct = a + b
-            elif op_symbol == '-':
-                correct = a - b
-            elif op_symbol in ("*", "×"):
-                correct = a * b
-            elif op_symbol in ("/", "÷"):
-                correct = a // b
-            else:
-                correct = None
+                    user_answer = None
+            # Résultat attendu déjà calculé à la génération de la série
+            correct = ex["result"]
             total_questions += 1
-            question_text = f"{a:3d} {op_symbol} {b:3d}"
-            if user_answer == "Not answered":
-                feedback[op].append({"text": f"{i+1:3d}. {question_text} = {user_answer}", "correct": False})
-            elif user_answer == correct:
-                feedback[op].append({"text": f"{i+1:3d}. {question_text} = {user_answer} -> Well done", "correct": True})
+            is_correct = user_answer is not None and user_answer == correct
+            if is_correct:
                 total_correct += 1
-            else:
-                feedback[op].append({"text": f"{i+1:3d}. {question_text} = {user_answer} -> Try again (expected {correct})", "correct": False})
+            # Valeurs brutes : le texte affiché est mis en forme par result.html
+            feedback[op].append({"idx": i + 1, "a": ex["a"], "b": ex["b"], "op": ex["op"],
+                                 "answer": user_answer, "expected": correct, "correct": is_correct})
     score = round((total_correct / total_questions) * 100) if total_questions > 0 else 0
-    solutions = {}
-    for op, ex_list in latest_exercises.items():
-        solutions[op] = []
-        for ex in ex_list:
-            question_text = f"{ex['a']:3d} {ex['op']} {ex['b']:3d}"
-            solutions[op].append({"question": question_text, "solution": ex["result"]})
-    host_address = f"{get_local_ip()}:5500"
-    rendered = render_template_string(result_template,
-                                      feedback=feedback,
-                                      score=score,
-                                      theme=theme,
-                                      host_address=host_address,
-                                      session=session)
-    latest_result = {"feedback": feedback,
-                     "solutions": solutions,
-                     "score": score,
-                     "theme": theme,
-                     "level": latest_meta["level"],
-                     "selected_category": latest_meta["selected_category"],
-                     "exercises": latest_exercises,
-                     "pdf_columns": latest_meta["pdf_columns"]}
+    rendered = render_template("result.html",
+                               feedback=feedback,
+                               score=score,
+                               theme=theme,
+                               host_address=HOST_ADDRESS,
+                               session=session)
+    state["result"] = {"feedback": feedback,
+                       "score": score,
+                       "theme": theme,
+                       "level": latest_meta["level"],
+                       "selected_category": latest_meta["selected_category"],
+                       "exercises": latest_exercises,
+                       "pdf_columns": latest_meta["pdf_columns"]}
     return rendered
 
 @app.route("/login", methods=["GET", "POST"])
@@ -1431,31 +1064,35 @@ def login_route():
         remember = request.form.get("remember")
         if email in users:
             stored_hash = users[email]["password"]
-            if stored_hash == hash_password(password):
+            if check_password(password, stored_hash):
                 session["user"] = email
+                # Migration des anciennes empreintes SHA-256 à la connexion
+                if not stored_hash.startswith(PASSWORD_HASH_PREFIX):
+                    users[email]["password"] = hash_password(password)
+                    mark_users_dirty()
                 flash("Login successful.", "success")
                 resp = make_response(redirect("/"))
                 if remember == "on":
                     token = secrets.token_hex(32)
-                    users[email]["remember_token"] = token
+                    set_remember_token(email, token)
                     expires = datetime.now() + timedelta(days=30)
                     resp.set_cookie("remember_token", token, expires=expires)
                     mark_users_dirty()
                 else:
                     resp.set_cookie("remember_token", "", expires=0)
-                    users[email].pop("remember_token", None)
-                    mark_users_dirty()
+                    if clear_remember_token(email):
+                        mark_users_dirty()
                 return resp
         flash("Invalid credentials.", "danger")
-    return render_template_string(login_template, session=session)
+    return render_template("login.html", session=session)
 
 @app.route("/logout")
 def logout_route():
     if "user" in session:
         email = session["user"]
-        if email in users:
-            users[email].pop("remember_token", None)
+        if email in users and clear_remember_token(email):
             mark_users_dirty()
+        drop_user_state(email)
     session.pop("user", None)
     flash("Logged out.", "info")
     resp = make_response(redirect("/login"))
@@ -1474,19 +1111,20 @@ def register_route():
         mother = request.form.get("mother_name")
         if email in users:
             flash("This email is already used.", "warning")
-            return render_template_string(register_template, session=session)
+            return render_template("register.html", session=session)
         if pw != cpw:
             flash("Passwords do not match.", "warning")
-            return render_template_string(register_template, session=session)
+            return render_template("register.html", session=session)
         users[email] = {"password": hash_password(pw),
                         "birth_date": birth_date,
                         "birth_place": birth_place,
                         "father_name": father,
-                        "mother_name": mother}
+                        "mother_name": mother,
+                        "usage_count": new_usage_count()}
         mark_users_dirty()
         flash("Account created successfully!", "success")
         return redirect("/login")
-    return render_template_string(register_template, session=session)
+    return render_template("register.html", session=session)
 
 @app.route("/forgot_password", methods=["GET", "POST"])
 def forgot_password_route():
@@ -1498,19 +1136,21 @@ def forgot_password_route():
         conf_pw = request.form.get("confirm_password")
         if email not in users:
             flash("Email not found.", "danger")
-            return render_template_string(forgot_template, session=session)
+            return render_template("forgot_password.html", session=session)
         if new_pw != conf_pw:
             flash("Passwords do not match.", "warning")
-            return render_template_string(forgot_template, session=session)
+            return render_template("forgot_password.html", session=session)
         user_data = users[email]
-        if user_data["father_name"] == father and user_data["mother_name"] == mother:
+        father_ok = secret_answer_matches(user_data["father_name"], father)
+        mother_ok = secret_answer_matches(user_data["mother_name"], mother)
+        if father_ok and mother_ok:
             user_data["password"] = hash_password(new_pw)
             mark_users_dirty()
             flash("Password reset successfully!", "success")
             return redirect("/login")
         else:
             flash("Incorrect verification information.", "danger")
-    return render_template_string(forgot_template, session=session)
+    return render_template("forgot_password.html", session=session)
 
 @app.route("/change_password", methods=["GET", "POST"])
 def change_password_route():
@@ -1523,24 +1163,17 @@ def change_password_route():
         conf_pw = request.form.get("confirm_password")
         email = session["user"]
         user_data = users[email]
-        if user_data["password"] != hash_password(old_pw):
+        if not check_password(old_pw, user_data["password"]):
             flash("Incorrect old password.", "danger")
-            return render_template_string(change_template, session=session)
+            return render_template("change_password.html", session=session)
         if new_pw != conf_pw:
             flash("New passwords do not match.", "warning")
-            return render_template_string(change_template, session=session)
+            return render_template("change_password.html", session=session)
         user_data["password"] = hash_password(new_pw)
         mark_users_dirty()
         flash("Password changed successfully!", "success")
         return redirect("/")
-    return render_template_string(change_template, session=session)
-
-@app.route("/logout")
-def root():
-    if "user" not in session:
-        return redirect("/login")
-    else:
-        return redirect("/")
+    return render_template("change_password.html", session=session)
 
 # ------------------------------
 # Lancement de l'application
@@ -0,0 +1,98 @@
+# ------------------------------
+# Construction du PDF d'exercices
+# ------------------------------
+# Module sans effet de bord : les processus du pool PDF (main.get_pdf_pool) l'importent seul,
+# sans recharger l'application
+from fpdf import FPDF
+from fpdf.enums import XPos, YPos
+
+# Symboles ASCII ramenés à leur forme typographique, par simple recherche dans une table
+PDF_OP_SYMBOLS = {"*": "×", "/": "÷"}
+
+def pdf_op_symbol(op_sym):
+    return PDF_OP_SYMBOLS.get(op_sym, op_sym)
+
+def format_exercise_boxes(ex_list):
+    # Textes de chaque case (numéro, a, opérateur, b) préparés en une passe avant le dessin
+    return [(f"{i}.", str(ex["a"]), pdf_op_symbol(ex["op"]), str(ex["b"])) for i, ex in enumerate(ex_list, 1)]
+
+def draw_exercise_box(pdf, label, a_text, op_sym, b_text, x, y, col_width, line_height, solution_text=None):
+    num_width = 12
+    content_width = col_width - num_width
+    pdf.set_font("Courier", "", 8)
+    pdf.set_xy(x, y)
+    pdf.cell(num_width, line_height, label, border=0, align="R")
+    pdf.set_font("Courier", "", 12)
+    pdf.set_xy(x + num_width, y)
+    pdf.cell(content_width, line_height, a_text, border=0, align="R", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.set_xy(x, y + line_height)
+    pdf.cell(num_width, line_height, op_sym, border=0, align="R")
+    pdf.set_xy(x + num_width, y + line_height)
+    pdf.cell(content_width, line_height, b_text, border='B', align="R", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.set_xy(x, y + 2 * line_height)
+    pdf.cell(num_width, line_height, "=", border=0, align="R")
+    pdf.set_xy(x + num_width, y + 2 * line_height)
+    if solution_text is None:
+        pdf.cell(content_width, line_height, "", border='B', align="R", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    else:
+        pdf.cell(content_width, line_height, solution_text, border=0, align="R", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+
+def draw_exercise_grid(pdf, boxes, solutions, pdf_columns, col_width, line_height):
+    # Géométrie de la grille lue une seule fois, hors de la boucle de dessin
+    box_height = 3 * line_height
+    row_step = box_height + 4
+    top = pdf.t_margin
+    bottom = pdf.h - pdf.b_margin
+    xs = [pdf.l_margin + col * col_width for col in range(pdf_columns)]
+    last_col = pdf_columns - 1
+    y = pdf.get_y()
+    for i, (label, a_text, op_sym, b_text) in enumerate(boxes):
+        col = i % pdf_columns
+        draw_exercise_box(pdf, label, a_text, op_sym, b_text, xs[col], y, col_width, line_height,
+                          solution_text=solutions[i] if solutions is not None else None)
+        if col == last_col:
+            y += row_step
+            if y + box_height > bottom:
+                pdf.add_page()
+                y = top
+
+def build_exercises_pdf(exercises, pdf_columns):
+    pdf = FPDF(orientation="P", unit="mm", format="A5")
+    pdf.set_margins(10, 10, 10)
+    pdf.set_auto_page_break(auto=True, margin=10)
+    pdf.add_page()
+    pdf.set_y(pdf.h / 2 - 20)
+    pdf.set_font("Helvetica", "B", 28)
+    pdf.cell(0, 10, "Math Exercises", new_x=XPos.LMARGIN, new_y=YPos.NEXT, align="C")
+    pdf.ln(10)
+    pdf.set_font("Helvetica", "I", 20)
+    pdf.cell(0, 10, "by SASTOUKA DIGITAL", new_x=XPos.LMARGIN, new_y=YPos.NEXT, align="C")
+    pdf.add_page()
+    pdf.set_font("Helvetica", "B", 18)
+    pdf.cell(0, 10, "Questions", new_x=XPos.LMARGIN, new_y=YPos.NEXT, align="C")
+    pdf.ln(5)
+    col_width = (pdf.w - pdf.l_margin - pdf.r_margin) / pdf_columns
+    line_height = 6
+    exercise_categories = list(exercises.items())
+    # Textes des cases formatés une fois, pour les questions comme pour les solutions
+    boxes_by_cat = {cat: format_exercise_boxes(ex_list) for cat, ex_list in exercise_categories}
+    for idx, (cat, ex_list) in enumerate(exercise_categories):
+        pdf.set_font("Helvetica", "B", 16)
+        pdf.cell(0, 10, cat.capitalize(), new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+        draw_exercise_grid(pdf, boxes_by_cat[cat], None, pdf_columns, col_width, line_height)
+        if idx != len(exercise_categories) - 1:
+            pdf.add_page()
+    pdf.add_page()
+    pdf.set_font("Helvetica", "B", 18)
+    pdf.cell(0, 10, "Solutions", new_x=XPos.LMARGIN, new_y=YPos.NEXT, align="C")
+    pdf.ln(5)
+    # Les solutions se lisent directement dans les exercices conservés (champ result)
+    for idx, (cat, ex_list) in enumerate(exercise_categories):
+        pdf.set_font("Helvetica", "B", 16)
+        pdf.cell(0, 10, cat.capitalize(), new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+        draw_exercise_grid(pdf, boxes_by_cat[cat], [str(ex["result"]) for ex in ex_list],
+                           pdf_columns, col_width, line_height)
+        if idx != len(exercise_categories) - 1:
+            pdf.add_page()
+    # Génération en mémoire, sans fichier local ni GCS : fpdf2 renvoie directement un bytearray
+    return pdf.output()
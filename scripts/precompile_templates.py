@@ -0,0 +1,24 @@
+# ------------------------------
+# Pré-compilation des templates Jinja (étape de build / déploiement)
+# ------------------------------
+# Remplit le cache de bytecode (.jinja_cache ou $JINJA_CACHE_DIR) pour que les workers
+# démarrent sans analyser aucun template. Usage : python scripts/precompile_templates.py
+# N'importe pas main : aucun thread, socket ni fichier de l'application n'est créé ici.
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+from jinja_settings import JINJA_CACHE_DIR, TEMPLATES_DIR, template_autoescape
+
+if __name__ == "__main__":
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+    env = Environment(loader=FileSystemLoader(TEMPLATES_DIR),
+                      bytecode_cache=FileSystemBytecodeCache(JINJA_CACHE_DIR),
+                      autoescape=template_autoescape)
+    names = env.list_templates()
+    for name in names:
+        env.get_template(name)
+    print(f"{len(names)} templates compiled to {JINJA_CACHE_DIR}")
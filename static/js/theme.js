@@ -0,0 +1,3 @@
+function changeTheme(theme) {
+    window.location.href = "/set_theme/" + theme;
+}